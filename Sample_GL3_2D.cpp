@@ -10,6 +10,8 @@
 #include <glm/gtx/transform.hpp>
 #include <glm/gtc/matrix_transform.hpp>
 
+#include "transform_ring.h"
+
 using namespace std;
 
 #define PB push_back
@@ -178,7 +180,10 @@ struct VAO* create3DObject (GLenum primitive_mode, int numVertices, const GLfloa
         color_buffer_data [3*i + 2] = blue;
     }
 
-    return create3DObject(primitive_mode, numVertices, vertex_buffer_data, color_buffer_data, fill_mode);
+    struct VAO* vao = create3DObject(primitive_mode, numVertices, vertex_buffer_data, color_buffer_data, fill_mode);
+    // glBufferData has copied the colors to the GPU, so the array is no longer needed
+    delete [] color_buffer_data;
+    return vao;
 }
 
 /* Render the VBOs handled by VAO */
@@ -204,6 +209,13 @@ void draw3DObject (struct VAO* vao)
     glDrawArrays(vao->PrimitiveMode, 0, vao->NumVertices); // Starting from vertex 0; 3 vertices total -> 1 triangle
 }
 
+/* Draw the VAO with model matrix frameTransforms[transform] */
+void drawTransformed(struct VAO* vao,int transform)
+{
+    selectTransform(transform);
+    draw3DObject(vao);
+}
+
 /**************************
  * Customizable functions *
  **************************/
@@ -216,39 +228,21 @@ const double ground=-50;
 double cfr=0.9;
 ///code////
 typedef VAO* vao;
-vector <vao> shapes;
-vector <vao> shapes1;
+/* A body is just its pose, velocity, mass and material; the mesh and the collision
+   polygon live apart, so bodies are cheap to store and never copied per frame */
 typedef struct str{
   double angle,vx,vy,last_time,x,y,radius,mass;
   double gravity,drag,friction;;
-  vector<glm::vec3> vertex;
   str(double angle,double x,double y,double time,double vx,double vy,double radius,double mass)
   : angle(angle), x(x), y(y), last_time(time), vx(vx), vy(vy), radius(radius), gravity(20), mass(mass), drag(5), friction(1) {}
-  GLfloat vertex_buffer_data[10000],color_buffer_data[10000];
-vao createPolygon(const vector<glm::vec3> &pts,GLfloat red,GLfloat blue,GLfloat green)
-{
-	GLfloat vertex_buffer_data[3*(pts.size()+2)];
-	vertex_buffer_data[0]=0;
-	vertex_buffer_data[1]=0;
-	vertex_buffer_data[2]=0;
-	for(auto it:pts)
-	 vertex.PB(it),vertex_buffer_data[0]+=it.x,vertex_buffer_data[1]+=it.y,vertex_buffer_data[2]+=it.z;
-	vertex_buffer_data[0]/=pts.size();
-	vertex_buffer_data[1]/=pts.size();
-	vertex_buffer_data[2]/=pts.size();
-	int i;
-	for(i=1;i<=pts.size();i++)
-	{
-		vertex_buffer_data[3*i]=pts[i-1].x;
-		vertex_buffer_data[3*i+1]=pts[i-1].y;
-		vertex_buffer_data[3*i+2]=pts[i-1].z;
-	}
-  vertex.PB(pts[0]);
-	vertex_buffer_data[3*i]=pts[0].x;
-	vertex_buffer_data[3*i+1]=pts[0].y;
-	vertex_buffer_data[3*i+2]=pts[0].z;
-	return (create3DObject(GL_TRIANGLE_FAN,pts.size()+2,vertex_buffer_data,red,blue,green));
-}
+  /* Where updateposition would put the body at time, without moving it */
+  DD positionAt(double time) const
+  {
+    double dt=time-last_time;
+    if(dt<=(1e-5)|| mass==(1e10)) return MP(x,y);
+    double v=(y==ground+radius)?0:vy;
+    return MP(x+vx*dt,max(ground+radius,y+(v*dt-(0.5*gravity*dt*dt))));
+  }
 	DD updateposition()
   {
     double current_time = glfwGetTime(),opposition;
@@ -268,6 +262,32 @@ vao createPolygon(const vector<glm::vec3> &pts,GLfloat red,GLfloat blue,GLfloat
       last_time=glfwGetTime();
   }
 }structure;
+/* Fan of triangles from the centre of pts; outline gets pts closed back on the first point */
+vao createPolygon(const vector<glm::vec3> &pts,vector<glm::vec3> &outline,GLfloat red,GLfloat blue,GLfloat green)
+{
+	vector<GLfloat> vertex_buffer_data(3*(pts.size()+2));
+	vertex_buffer_data[0]=0;
+	vertex_buffer_data[1]=0;
+	vertex_buffer_data[2]=0;
+	outline.clear();
+	for(auto it:pts)
+	 outline.PB(it),vertex_buffer_data[0]+=it.x,vertex_buffer_data[1]+=it.y,vertex_buffer_data[2]+=it.z;
+	vertex_buffer_data[0]/=pts.size();
+	vertex_buffer_data[1]/=pts.size();
+	vertex_buffer_data[2]/=pts.size();
+	int i;
+	for(i=1;i<=pts.size();i++)
+	{
+		vertex_buffer_data[3*i]=pts[i-1].x;
+		vertex_buffer_data[3*i+1]=pts[i-1].y;
+		vertex_buffer_data[3*i+2]=pts[i-1].z;
+	}
+  outline.PB(pts[0]);
+	vertex_buffer_data[3*i]=pts[0].x;
+	vertex_buffer_data[3*i+1]=pts[0].y;
+	vertex_buffer_data[3*i+2]=pts[0].z;
+	return (create3DObject(GL_TRIANGLE_FAN,pts.size()+2,vertex_buffer_data.data(),red,blue,green));
+}
 vector <glm::vec3>  createCircle(DD O,double radius)
 {
   vector<glm::vec3> pts;
@@ -302,29 +322,19 @@ double dotproduct(glm::vec3 a,glm::vec3 b){
 double crossproduct(glm::vec3 a,glm::vec3 b){   ///in 2d only
   return  ((a.x*b.y)-(a.y*b.x));
 }
-bool check_collision(structure &ball,structure a)
+bool debug_collisions=false;    // print every bounce, toggled with D
+/* Bounce the ball, which is at A now, off the edge from p to q if it is within radius of it */
+bool check_collision(structure &ball,DD A,const glm::vec3 &p,const glm::vec3 &q)
 {
   cfr=0.9;
-  structure A=ball;
-    A.updateposition();
-    for(int i=0;i+1<a.vertex.size();i++)
-    {
-        glm::vec3 vec; vec.x=A.x;vec.y=A.y ;vec.z=0;
-        //cout<<vec.x<<" "<<vec.y<<" "<<vec.z<<endl;
-      //  cout<<a.vertex[i].x<<" "<<a.vertex[i].y<<" "<<a.vertex[i].z<<endl;
-      //  cout<<a.vertex[i+1].x<<" "<<a.vertex[i+1].y<<" "<<a.vertex[i+1].z<<endl;
-        glm::vec3 vec1=vectorr(a.vertex[i+1],a.vertex[i]),vec2=vectorr(vec,a.vertex[i]),vec3=vectorr(vec,a.vertex[i+1]);
-        //cout<<"starts"<<endl;
-        if(abs(crossproduct(vec1,vec2)/(length(vec1)))>ball.radius) continue;
-        //cout<<"return1"<<endl;
-      //  cout<<vec1.x<<" "<<vec2.x<<" "<<vec1.y<<" "<<vec2.y<<" "<<vec1.z<<" "<<vec2.z<<endl;
-      //  cout<<dotproduct(vec1,vec2)<<" "<< dotproduct(vec1,vec3)<<endl;
-        if(dotproduct(vec1,vec2)<0 || dotproduct(vec1,vec3)>0) continue;
-        //  cout<<"return2"<<endl;
+        glm::vec3 vec; vec.x=A.F;vec.y=A.S ;vec.z=0;
+        glm::vec3 vec1=vectorr(q,p),vec2=vectorr(vec,p),vec3=vectorr(vec,q);
+        if(abs(crossproduct(vec1,vec2)/(length(vec1)))>ball.radius) return 0;
+        if(dotproduct(vec1,vec2)<0 || dotproduct(vec1,vec3)>0) return 0;
         double cs=vec1.x/length(vec1);
         double sn=vec1.y/length(vec1);
-        cout<<ball.vx<<" vel bef "<<ball.vy<<endl;
-        cout<<cs<<" "<<sn<<endl;
+        if(debug_collisions)
+          cout<<ball.vx<<" vel bef "<<ball.vy<<endl<<cs<<" "<<sn<<endl;
         double per=(-ball.vx*sn)+(ball.vy*cs);
         double alng=(ball.vx*cs)+(ball.vy*sn);
         per=-cfr*per;
@@ -332,16 +342,79 @@ bool check_collision(structure &ball,structure a)
         ball.vy=(per*cs)+(alng*sn);
         //ball.vx=(ball.vx*cs)+(cfr*ball.vx*sn);
         //ball.vy=((ball.vy*sn))-(cfr*ball.vy*cs);
-        cout<<ball.vx<<" vel after "<<ball.vy<<endl;
         ball.x=vec.x;ball.y=vec.y;ball.last_time=glfwGetTime();
         ball.updateposition();
-        cout<<ball.x<<" "<<ball.y<<endl;
+        if(debug_collisions)
+          cout<<ball.vx<<" vel after "<<ball.vy<<endl<<ball.x<<" "<<ball.y<<endl;
       return 1;
-    }
-    return 0;
 }
 vector<structure> structures;
+vector <vao> shapes;                        // mesh of structures[i]
+vector <vector<glm::vec3> > outlines;       // collision polygon of structures[i]
 vector<structure> balls;
+vao ballMesh;                               // every ball is drawn with this one
+
+/* Uniform grid over the edges of the outlines, which never move, so a ball only
+   tests the edges near its path */
+const double edge_cell=10;
+vector <pair<int,int> > edges;                      // (structure, first point of the edge in its outline)
+unordered_map<long long, vector<int> > edgeGrid;    // cell -> indices into edges, in increasing order
+vector <int> nearEdges;
+int edgeCell(double v)
+{
+  return (int)floor(v/edge_cell);
+}
+long long edgeKey(int cx,int cy)
+{
+  return ((long long)cx<<32)^(unsigned int)cy;
+}
+void buildEdgeGrid()
+{
+  edges.clear();
+  edgeGrid.clear();
+  for(int s=0;s<outlines.size();s++)
+    for(int i=0;i+1<outlines[s].size();i++)
+    {
+      const glm::vec3 &p=outlines[s][i],&q=outlines[s][i+1];
+      for(int cx=edgeCell(min(p.x,q.x));cx<=edgeCell(max(p.x,q.x));cx++)
+        for(int cy=edgeCell(min(p.y,q.y));cy<=edgeCell(max(p.y,q.y));cy++)
+          edgeGrid[edgeKey(cx,cy)].PB(edges.size());
+      edges.PB(MP(s,i));
+    }
+}
+/* The edges in the cells the box touches, in structure order and outline order within one */
+void queryEdges(double x0,double y0,double x1,double y1,vector<int> &out)
+{
+  out.clear();
+  for(int cx=edgeCell(x0);cx<=edgeCell(x1);cx++)
+    for(int cy=edgeCell(y0);cy<=edgeCell(y1);cy++)
+    {
+      unordered_map<long long, vector<int> >::const_iterator it=edgeGrid.find(edgeKey(cx,cy));
+      if(it!=edgeGrid.end())
+        out.insert(out.end(),it->second.begin(),it->second.end());
+    }
+  sort(out.begin(),out.end());
+  out.erase(unique(out.begin(),out.end()),out.end());
+}
+/* Bounce the ball off each structure from first on at most once, at the first edge of its
+   outline the ball is within radius of. Only edges near the ball's path since from are tested */
+void collideBall(structure &ball,int first,double from)
+{
+  double now=glfwGetTime(),r=ball.radius;
+  DD a=ball.positionAt(from),A=ball.positionAt(now);
+  queryEdges(min(a.F,A.F)-r,min(a.S,A.S)-r,max(a.F,A.F)+r,max(a.S,A.S)+r,nearEdges);
+  int bounced=-1;
+  for(int k=0;k<nearEdges.size();k++)
+  {
+    int s=edges[nearEdges[k]].F,i=edges[nearEdges[k]].S;
+    if(s<first||s==bounced) continue;
+    if(check_collision(ball,A,outlines[s][i],outlines[s][i+1]))
+    {
+      bounced=s;
+      A=ball.positionAt(glfwGetTime());
+    }
+  }
+}
 
 /* Executed when a regular key is pressed/released/held-down */
 /* Prefered for Keyboard events */
@@ -369,12 +442,13 @@ void keyboard (GLFWwindow* window, int key, int scancode, int action, int mods)
             case GLFW_KEY_S:
                 speed=speed-5;
                 break;
+            case GLFW_KEY_D:
+                debug_collisions=!debug_collisions;
+                break;
             case GLFW_KEY_SPACE:
               if(time-last_time > 0.5){
               cout<<speed<<endl;
               structure  ball(0,structures[1].x+(22*cos(structures[1].angle*M_PI/180.0f)),structures[1].y+(22*sin(structures[1].angle*M_PI/180.0f)),glfwGetTime(),0.0,0.0,2.5,40.0);
-              vector <glm::vec3> v=createCircle(MP(0,0),3.0);
-              shapes1.PB(ball.createPolygon(v,0,0,0));
               ball.set_vel(speed,structures[1].angle);
               ball.updateposition();
             //  ball.angle+=structures[0].angle;
@@ -484,51 +558,34 @@ void draw ()
   //  Don't change unless you are sure!!
   glm::mat4 VP = Matrices.projection * Matrices.view;
 
-  // Send our transformation to the currently bound shader, in the "MVP" uniform
-  // For each model you render, since the MVP will be different (at least the M part)
-  //  Don't change unless you are sure!!
-  glm::mat4 MVP;	// MVP = Projection * View * Model
-
-  // Load identity to model matrix
+  // VP goes to the shader once per frame, in the "VP" uniform; the model matrices
+  // come from the transform ring and are multiplied in on the GPU
+  frameTransforms.clear();
   for(int i=0;i<structures.size();i++)
   {
-    Matrices.model = glm::mat4(1.0f);
-    structure A=structures[i];
-    vao shape=shapes[i];
-    /* Render your scene */
-//    A.updateposition();
-
+    const structure &A=structures[i];
     glm::mat4 translate = glm::translate (glm::vec3(A.x, A.y, 0.0f)); // glTranslatef
     glm::mat4 rotate = glm::rotate((float)(A.angle*M_PI/180.0f), glm::vec3(0,0,1));  // rotate about vector (1,0,0)
-    glm::mat4 Transform = translate* rotate;
-    Matrices.model *= Transform;
-    MVP = VP * Matrices.model; // MVP = p * V * M
-
-    //  Don't change unless you are sure!!
-    glUniformMatrix4fv(Matrices.MatrixID, 1, GL_FALSE, &MVP[0][0]);
-
-    // draw3DObject draws the VAO given to it using current MVP matrix
-    draw3DObject(shape);
-}
-for(int i=0;i<balls.size();i++)
-{
-  Matrices.model = glm::mat4(1.0f);
-  structure A=balls[i];
-  vao shape=shapes1[i];
-  /* Render your scene */
-  A.updateposition();
-  glm::mat4 translate = glm::translate (glm::vec3(A.x, A.y, 0.0f)); // glTranslatef
-  glm::mat4 rotate = glm::rotate((float)(A.angle*M_PI/180.0f), glm::vec3(0,0,1));  // rotate about vector (1,0,0)
-  glm::mat4 Transform = translate* rotate;
-  Matrices.model *= Transform;
-  MVP = VP * Matrices.model; // MVP = p * V * M
-
-  //  Don't change unless you are sure!!
-  glUniformMatrix4fv(Matrices.MatrixID, 1, GL_FALSE, &MVP[0][0]);
+    frameTransforms.PB(translate * rotate);
+  }
+  double now=glfwGetTime();
+  for(int i=0;i<balls.size();i++)
+  {
+    const structure &A=balls[i];
+    DD pos=A.positionAt(now);
+    glm::mat4 translate = glm::translate (glm::vec3(pos.F, pos.S, 0.0f)); // glTranslatef
+    glm::mat4 rotate = glm::rotate((float)(A.angle*M_PI/180.0f), glm::vec3(0,0,1));  // rotate about vector (1,0,0)
+    frameTransforms.PB(translate * rotate);
+  }
+  uploadTransforms();
+  glUniformMatrix4fv(Matrices.MatrixID, 1, GL_FALSE, &VP[0][0]);
 
-  // draw3DObject draws the VAO given to it using current MVP matrix
-  draw3DObject(shape);
- }
+  // draw3DObject draws the VAO given to it using its model matrix from the ring
+  for(int i=0;i<structures.size();i++)
+    drawTransformed(shapes[i], i);
+  for(int i=0;i<balls.size();i++)
+    drawTransformed(ballMesh, structures.size()+i);
+  fenceTransforms();
 }
 
 /* Initialise glfw window, I/O callbacks and the renderer to use */
@@ -593,28 +650,35 @@ void initGL (GLFWwindow* window, int width, int height)
   structure gound(0,0,0,glfwGetTime(),0,0,6,(1e10));
   vector <glm::vec3> v1;
   v1.PB(invec(-80,ground+2,0));v1.PB(invec(-80,-78,0));v1.PB(invec(80,-78,0));v1.PB(invec(80,ground+2,0));
-  shapes.PB(gound.createPolygon(v1,0,0.4,0));
+  outlines.PB(vector<glm::vec3>());
+  shapes.PB(createPolygon(v1,outlines.back(),0,0.4,0));
   structures.PB(gound);
   structure canon(0,-60,ground,glfwGetTime(),0,0,6,std::numeric_limits<double>::infinity());
   //cout<<"here"<<endl;
 	vector <glm::vec3> v=createCircle(MP(0,0),6);
   //cout<<"here"<<endl;
   v.PB(invec(0,6,0));v.PB(invec(0,-6,0));v.PB(invec(20,-3,0));v.PB(invec(20,3,0));v.PB(invec(0,6,0));
-  shapes.PB(canon.createPolygon(v,0.3,0.3,0.3));
+  outlines.PB(vector<glm::vec3>());
+  shapes.PB(createPolygon(v,outlines.back(),0.3,0.3,0.3));
   structures.PB(canon);
   structure rock(0,0,0,glfwGetTime(),0,0,6,(1e10));
   //cout<<"here"<<endl;
   v.clear();
   //cout<<"here"<<endl;
  v.PB(invec(12,ground,0));v.PB(invec(6,ground+6,0));  v.PB(invec( 11,0,0));v.PB(invec(35,0,0));v.PB(invec(40,ground+6,0));v.PB(invec(34,ground,0));
-  shapes.PB(rock.createPolygon(v,0.5,0.4,0.4));
+  outlines.PB(vector<glm::vec3>());
+  shapes.PB(createPolygon(v,outlines.back(),0.5,0.4,0.4));
   structures.PB(rock);
   //cout<<"here"<<endl;
+  vector<glm::vec3> ballOutline;
+  ballMesh=createPolygon(createCircle(MP(0,0),3.0),ballOutline,0,0,0);
+  buildEdgeGrid();
 
 	// Create and compile our GLSL program from the shaders
-	programID = LoadShaders( "Sample_GL.vert", "Sample_GL.frag" );
-	// Get a handle for our "MVP" uniform
-	Matrices.MatrixID = glGetUniformLocation(programID, "MVP");
+	programID = LoadShaders( "Sample_GL_transforms.vert", "Sample_GL.frag" );
+	// Get a handle for our "VP" uniform, the model matrices come from the transform ring
+	Matrices.MatrixID = glGetUniformLocation(programID, "VP");
+	useTransformRing(programID);
 
 
 	reshapeWindow (window, width, height);
@@ -645,16 +709,14 @@ int main (int argc, char** argv)
 	initGL (window, width, height);
 
     double last_update_time = glfwGetTime(), current_time;
+    double last_check_time = last_update_time;    // balls are swept from here to now
 
   //  Draw in loop
     while (!glfwWindowShouldClose(window)) {
 
         // OpenGL Draw commands
         for(int i=0;i<balls.size();i++)
-          for(int j=0;j<structures.size();j++)
-            {
-                check_collision(balls[i],structures[j]);
-            }
+            collideBall(balls[i],0,last_check_time);
         draw();
 
         // Swap Frame Buffer in double buffering
@@ -667,12 +729,10 @@ int main (int argc, char** argv)
         current_time = glfwGetTime(); // Time in seconds
         if ((current_time - last_update_time) >= 0.2) { // atleast 0.5s elapsed since last frame
           for(int i=0;i<balls.size();i++)
-            for(int j=1;j<structures.size();j++)
-              {
-                  check_collision(balls[i],structures[j]);
-              }
+            collideBall(balls[i],1,last_check_time);
             last_update_time = current_time;
         }
+        last_check_time = current_time;
     }
 
     glfwTerminate();
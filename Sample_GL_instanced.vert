@@ -0,0 +1,27 @@
+#version 330 core
+
+// input data : sent from main program
+layout (location = 0) in vec3 vertexPosition;
+layout (location = 1) in vec3 vertexColor;
+
+// per-instance data : where this copy of the mesh sits in the world (xyz)
+// and how big it is (w, 0 for a removed copy)
+layout (location = 2) in vec4 instanceOffset;
+
+uniform mat4 VP;
+
+// output data : used by fragment shader
+out vec3 fragColor;
+
+void main ()
+{
+    // The model matrix of every instance is a scale and a translation
+    vec4 v = vec4(vertexPosition*instanceOffset.w + instanceOffset.xyz, 1);
+
+    // The color of each vertex will be interpolated
+    // to produce the color of each fragment
+    fragColor = vertexColor;
+
+    // Output position of the vertex, in clip space : VP * position
+    gl_Position = VP * v;
+}
@@ -0,0 +1,30 @@
+#version 330 core
+
+// input data : sent from main program
+layout (location = 0) in vec3 vertexPosition;
+layout (location = 1) in vec3 vertexColor;
+
+// model matrices of the objects drawn this frame, seen 256 at a time
+layout (std140) uniform ObjectTransforms
+{
+    mat4 model[256];
+};
+
+// which of them this draw uses
+uniform int objectIndex;
+uniform mat4 VP;
+
+// output data : used by fragment shader
+out vec3 fragColor;
+
+void main ()
+{
+    vec4 v = vec4(vertexPosition, 1); // Transform an homogeneous 4D vector
+
+    // The color of each vertex will be interpolated
+    // to produce the color of each fragment
+    fragColor = vertexColor;
+
+    // Output position of the vertex, in clip space : VP * model * position
+    gl_Position = VP * model[objectIndex] * v;
+}
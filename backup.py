@@ -2,28 +2,60 @@
 #include <cmath>
 #include <fstream>
 #include <vector>
+#include <algorithm>
+#include <cfloat>
+#include <unordered_map>
+#include <map>
+#include <list>
+#include <chrono>
+#include <random>
+#include <cstring>
+#include <cstddef>
+#include <thread>
+#include <mutex>
+#include <condition_variable>
+#include <functional>
+
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <fcntl.h>
+#include <unistd.h>
 
 #include <glad/glad.h>
 #include <GLFW/glfw3.h>
+#include <EGL/egl.h>
+#include <EGL/eglext.h>
 
 #define GLM_FORCE_RADIANS
 #include <glm/glm.hpp>
 #include <glm/gtx/transform.hpp>
 #include <glm/gtc/matrix_transform.hpp>
 
+#include "transform_ring.h"
+
 using namespace std;
 
 struct VAO {
     GLuint VertexArrayID;
-    GLuint VertexBuffer;
+    GLuint VertexBuffer;    // positions, or packedVertex records when ColorBuffer is 0
     GLuint ColorBuffer;
+    GLuint IndexBuffer;     // 0 when drawn with glDrawArrays
 
     GLenum PrimitiveMode;
     GLenum FillMode;
+    GLenum IndexType;
     int NumVertices;
+    int NumIndices;
 };
 typedef struct VAO VAO;
 
+/* Compact interleaved vertex of indexed meshes: half float position and RGBA8 color, 12 bytes */
+typedef struct packedVertex
+{
+    GLhalf x,y,z,pad;
+    GLubyte r,g,b,a;
+}packedVertex;
+
 struct GLMatrices {
 	glm::mat4 projection;
 	glm::mat4 model;
@@ -33,81 +65,452 @@ struct GLMatrices {
 
 GLuint programID;
 
-/* Function to load Shaders - Use it as it is */
-GLuint LoadShaders(const char * vertex_file_path,const char * fragment_file_path) {
+/* Program and "VP" uniform for drawing many copies of a mesh in one call */
+GLuint instancedProgramID;
+GLuint instancedVPID;
 
-	// Create the shaders
-	GLuint VertexShaderID = glCreateShader(GL_VERTEX_SHADER);
-	GLuint FragmentShaderID = glCreateShader(GL_FRAGMENT_SHADER);
-
-	// Read the Vertex Shader code from the file
-	std::string VertexShaderCode;
-	std::ifstream VertexShaderStream(vertex_file_path, std::ios::in);
-	if(VertexShaderStream.is_open())
-	{
-		std::string Line = "";
-		while(getline(VertexShaderStream, Line))
-			VertexShaderCode += "\n" + Line;
-		VertexShaderStream.close();
-	}
+/* Run the game logic only: no window, no GL context, no VAOs */
+bool headless = false;
+bool offscreen = false;     // drawing into a framebuffer object, no window
 
-	// Read the Fragment Shader code from the file
-	std::string FragmentShaderCode;
-	std::ifstream FragmentShaderStream(fragment_file_path, std::ios::in);
-	if(FragmentShaderStream.is_open()){
-		std::string Line = "";
-		while(getline(FragmentShaderStream, Line))
-			FragmentShaderCode += "\n" + Line;
-		FragmentShaderStream.close();
-	}
+/* Where each frame's time goes, in milliseconds. The simulation stages add up
+   over all the steps run in the frame; gpu is measured with timer queries */
+enum { STAGE_TILES, STAGE_PHYSICS, STAGE_DRAW, STAGE_SWAP, STAGE_FRAME, STAGE_GPU, NUM_STAGES };
+const char *stage_names[NUM_STAGES] = { "tiles", "physics", "draw", "swap", "frame", "gpu" };
+typedef struct frameProfile
+{
+    float ms[NUM_STAGES];
+    int steps, drawCalls, uniformUploads;
+    int redundantCalls;                 // GL calls skipped by the state cache
+}frameProfile;
+/* Frames kept for the rolling percentiles */
+const int profile_window = 240;
+/* Timer queries in flight; results are read this many frames later so we never stall */
+const int gpu_queries = 3;
+typedef struct profiler
+{
+    bool enabled;
+    const char *dump_path;              // write every frame here on exit, .json for a summary
+    frameProfile current;
+    long long frames;
+    vector<frameProfile> recent;        // ring of the last profile_window frames
+    vector<frameProfile> history;       // every frame, only kept when dumping
+    std::chrono::steady_clock::time_point started[NUM_STAGES];
+    std::chrono::steady_clock::time_point frame_start;
+    GLuint queries[gpu_queries];
+    long long query_frame[gpu_queries]; // frame each query measured, -1 when free
+}profiler;
+profiler profile;
+
+void profileBegin(int stage)
+{
+    if(profile.enabled)
+        profile.started[stage]=std::chrono::steady_clock::now();
+}
+void profileEnd(int stage)
+{
+    if(profile.enabled)
+        profile.current.ms[stage]+=std::chrono::duration<float,std::milli>(std::chrono::steady_clock::now()-profile.started[stage]).count();
+}
+/* Look up a frame that is still remembered, NULL if it is too old */
+frameProfile* profiledFrame(long long frame)
+{
+    if(!profile.history.empty())
+        return frame<profile.history.size()?&profile.history[frame]:NULL;
+    if(frame<=profile.frames-profile_window||frame>=profile.frames)
+        return NULL;
+    return &profile.recent[frame%profile_window];
+}
+/* Collect GPU times of earlier frames whose queries have finished */
+void collectGpuQueries()
+{
+    for(int q=0;q<gpu_queries;q++)
+    {
+        if(profile.query_frame[q]<0)
+            continue;
+        GLint ready=0;
+        glGetQueryObjectiv(profile.queries[q], GL_QUERY_RESULT_AVAILABLE, &ready);
+        if(!ready)
+            continue;
+        GLuint64 ns;
+        glGetQueryObjectui64v(profile.queries[q], GL_QUERY_RESULT, &ns);
+        frameProfile *f=profiledFrame(profile.query_frame[q]);
+        if(f)
+            f->ms[STAGE_GPU]=ns/1e6;
+        profile.query_frame[q]=-1;
+    }
+}
+void initProfiler(bool with_gpu)
+{
+    profile.enabled=true;
+    profile.frames=0;
+    profile.recent.assign(profile_window, frameProfile());
+    profile.history.clear();
+    memset(&profile.current, 0, sizeof(profile.current));
+    profile.current.ms[STAGE_GPU]=-1;
+    for(int q=0;q<gpu_queries;q++)
+        profile.query_frame[q]=-1;
+    if(with_gpu)
+        glGenQueries(gpu_queries, profile.queries);
+    profile.frame_start=std::chrono::steady_clock::now();
+}
+/* Time the GL commands of this frame, skipped if every query is still busy */
+int gpuTimerBegin()
+{
+    if(!profile.enabled)
+        return -1;
+    collectGpuQueries();
+    for(int q=0;q<gpu_queries;q++)
+        if(profile.query_frame[q]<0)
+        {
+            profile.query_frame[q]=profile.frames;
+            glBeginQuery(GL_TIME_ELAPSED, profile.queries[q]);
+            return q;
+        }
+    return -1;
+}
+void gpuTimerEnd(int q)
+{
+    if(q>=0)
+        glEndQuery(GL_TIME_ELAPSED);
+}
+void profileEndFrame()
+{
+    if(!profile.enabled)
+        return;
+    std::chrono::steady_clock::time_point now=std::chrono::steady_clock::now();
+    profile.current.ms[STAGE_FRAME]=std::chrono::duration<float,std::milli>(now-profile.frame_start).count();
+    profile.frame_start=now;
+    profile.recent[profile.frames%profile_window]=profile.current;
+    if(profile.dump_path)
+        profile.history.push_back(profile.current);
+    profile.frames++;
+    memset(&profile.current, 0, sizeof(profile.current));
+    profile.current.ms[STAGE_GPU]=-1;
+}
+/* p-th percentile (0-100) of a stage over frames; frames without a sample are left out */
+float stagePercentile(const vector<frameProfile> &frames,int count,int stage,float p)
+{
+    vector<float> v;
+    for(int i=0;i<count;i++)
+        if(frames[i].ms[stage]>=0)
+            v.push_back(frames[i].ms[stage]);
+    if(v.empty())
+        return -1;
+    int k=min((int)v.size()-1,(int)(p/100*v.size()));
+    nth_element(v.begin(), v.begin()+k, v.end());
+    return v[k];
+}
+/* One line summary of the recent frames, for the window title */
+string profileSummary()
+{
+    int n=min<long long>(profile.frames,profile_window);
+    const frameProfile &last=profile.recent[(profile.frames+profile_window-1)%profile_window];
+    char text[256];
+    snprintf(text, sizeof(text), "frame %.2f/%.2f/%.2f ms  sim %.2f  draw %.2f  gpu %.2f  swap %.2f  calls %d  uniforms %d  skipped %d",
+             stagePercentile(profile.recent,n,STAGE_FRAME,50), stagePercentile(profile.recent,n,STAGE_FRAME,95),
+             stagePercentile(profile.recent,n,STAGE_FRAME,99),
+             stagePercentile(profile.recent,n,STAGE_TILES,50)+stagePercentile(profile.recent,n,STAGE_PHYSICS,50),
+             stagePercentile(profile.recent,n,STAGE_DRAW,50), stagePercentile(profile.recent,n,STAGE_GPU,50),
+             stagePercentile(profile.recent,n,STAGE_SWAP,50), last.drawCalls, last.uniformUploads, last.redundantCalls);
+    return text;
+}
+/* Write the recorded frames: one CSV row per frame, or percentiles per stage if the name ends in .json */
+void writeProfile()
+{
+    if(!profile.enabled||!profile.dump_path)
+        return;
+    collectGpuQueries();
+    FILE *out=fopen(profile.dump_path, "w");
+    if(!out){
+        fprintf(stderr, "Cannot write profile %s\n", profile.dump_path);
+        return;
+    }
+    const vector<frameProfile> &frames=profile.history;
+    int n=frames.size();
+    const char *ext=strrchr(profile.dump_path, '.');
+    if(ext&&!strcmp(ext, ".json")){
+        long long calls=0, uniforms=0, skipped=0, steps=0;
+        for(int i=0;i<n;i++)
+            calls+=frames[i].drawCalls, uniforms+=frames[i].uniformUploads, skipped+=frames[i].redundantCalls, steps+=frames[i].steps;
+        fprintf(out, "{\n  \"frames\": %d,\n  \"steps\": %lld,\n", n, steps);
+        fprintf(out, "  \"draw_calls_per_frame\": %.2f,\n  \"uniform_uploads_per_frame\": %.2f,\n  \"redundant_calls_skipped_per_frame\": %.2f,\n  \"ms\": {\n",
+                n?(double)calls/n:0.0, n?(double)uniforms/n:0.0, n?(double)skipped/n:0.0);
+        for(int s=0;s<NUM_STAGES;s++)
+        {
+            if(stagePercentile(frames,n,s,50)<0){
+                // never measured, e.g. gpu in a headless run
+                fprintf(out, "    \"%s\": null%s\n", stage_names[s], s+1<NUM_STAGES?",":"");
+                continue;
+            }
+            fprintf(out, "    \"%s\": {\"p50\": %.4f, \"p95\": %.4f, \"p99\": %.4f}%s\n", stage_names[s],
+                    stagePercentile(frames,n,s,50), stagePercentile(frames,n,s,95), stagePercentile(frames,n,s,99),
+                    s+1<NUM_STAGES?",":"");
+        }
+        fprintf(out, "  }\n}\n");
+    }
+    else{
+        fprintf(out, "frame");
+        for(int s=0;s<NUM_STAGES;s++)
+            fprintf(out, ",%s_ms", stage_names[s]);
+        fprintf(out, ",steps,draw_calls,uniform_uploads,redundant_calls_skipped\n");
+        for(int i=0;i<n;i++)
+        {
+            fprintf(out, "%d", i);
+            for(int s=0;s<NUM_STAGES;s++)
+                fprintf(out, ",%.4f", frames[i].ms[s]);
+            fprintf(out, ",%d,%d,%d,%d\n", frames[i].steps, frames[i].drawCalls, frames[i].uniformUploads, frames[i].redundantCalls);
+        }
+    }
+    fclose(out);
+}
 
-	GLint Result = GL_FALSE;
-	int InfoLogLength;
+/* glUniformMatrix4fv for one matrix, counted by the profiler */
+void uploadMatrix(GLint location,const glm::mat4 &m)
+{
+    glUniformMatrix4fv(location, 1, GL_FALSE, &m[0][0]);
+    profile.current.uniformUploads++;
+}
 
-	// Compile Vertex Shader
-	printf("Compiling shader : %s\n", vertex_file_path);
-	char const * VertexSourcePointer = VertexShaderCode.c_str();
-	glShaderSource(VertexShaderID, 1, &VertexSourcePointer , NULL);
-	glCompileShader(VertexShaderID);
-
-	// Check Vertex Shader
-	glGetShaderiv(VertexShaderID, GL_COMPILE_STATUS, &Result);
-	glGetShaderiv(VertexShaderID, GL_INFO_LOG_LENGTH, &InfoLogLength);
-	std::vector<char> VertexShaderErrorMessage(InfoLogLength);
-	glGetShaderInfoLog(VertexShaderID, InfoLogLength, NULL, &VertexShaderErrorMessage[0]);
-	fprintf(stdout, "%s\n", &VertexShaderErrorMessage[0]);
-
-	// Compile Fragment Shader
-	printf("Compiling shader : %s\n", fragment_file_path);
-	char const * FragmentSourcePointer = FragmentShaderCode.c_str();
-	glShaderSource(FragmentShaderID, 1, &FragmentSourcePointer , NULL);
-	glCompileShader(FragmentShaderID);
+/* The GL state last set through the functions below, so a call that would change
+   nothing is skipped and counted instead. Anything that changes this state behind
+   their back, like deleting what is bound, has to forgetGLState() */
+const GLuint unknown_state = ~0u;
+typedef struct glStateCache
+{
+    GLuint program;
+    GLuint vertexArray;
+    GLuint arrayBuffer;
+    GLenum fillMode;
+}glStateCache;
+glStateCache glState = {unknown_state, unknown_state, unknown_state, unknown_state};
+
+void forgetGLState()
+{
+    glState.program=glState.vertexArray=glState.arrayBuffer=glState.fillMode=unknown_state;
+}
+void useProgram(GLuint program)
+{
+    if(glState.program==program){
+        profile.current.redundantCalls++;
+        return;
+    }
+    glUseProgram(program);
+    glState.program=program;
+}
+void bindVertexArray(GLuint vertexArray)
+{
+    if(glState.vertexArray==vertexArray){
+        profile.current.redundantCalls++;
+        return;
+    }
+    glBindVertexArray(vertexArray);
+    glState.vertexArray=vertexArray;
+}
+void bindArrayBuffer(GLuint buffer)
+{
+    if(glState.arrayBuffer==buffer){
+        profile.current.redundantCalls++;
+        return;
+    }
+    glBindBuffer(GL_ARRAY_BUFFER, buffer);
+    glState.arrayBuffer=buffer;
+}
+void setFillMode(GLenum mode)
+{
+    if(glState.fillMode==mode){
+        profile.current.redundantCalls++;
+        return;
+    }
+    glPolygonMode(GL_FRONT_AND_BACK, mode);
+    glState.fillMode=mode;
+}
+
+/* Read a whole file in one go, empty if it can't be opened */
+string readFile(const char *path,bool report=true)
+{
+    string data;
+    std::ifstream in(path, std::ios::in|std::ios::binary);
+    if(!in.is_open()){
+        if(report)
+            fprintf(stderr, "Cannot open %s\n", path);
+        return data;
+    }
+    in.seekg(0, std::ios::end);
+    data.resize(in.tellg());
+    in.seekg(0, std::ios::beg);
+    if(!data.empty())
+        in.read(&data[0], data.size());
+    return data;
+}
+
+/* 64 bit FNV-1a, continued from h */
+unsigned long long hashBytes(const char *p,size_t n,unsigned long long h=14695981039346656037ULL)
+{
+    for(size_t i=0;i<n;i++)
+        h=(h^(unsigned char)p[i])*1099511628211ULL;
+    return h;
+}
+
+/* Linked programs are kept in shader_cache_dir as <key>.bin: the binary format
+   followed by the glGetProgramBinary blob. The key hashes both sources and the
+   driver strings, so editing a shader or updating the driver misses the cache */
+const char *shader_cache_dir = ".shadercache";
+
+/* A program that may still be compiling on the driver's threads */
+typedef struct shaderProgram
+{
+    GLuint id;
+    GLuint vertex, fragment;    // 0 once the program came from the cache
+    const char *vertex_path, *fragment_path;
+    unsigned long long key;
+}shaderProgram;
+
+bool programBinaries()
+{
+    GLint formats=0;
+    if(GLAD_GL_ARB_get_program_binary)
+        glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS, &formats);
+    return formats>0;
+}
+
+string shaderCachePath(unsigned long long key)
+{
+    char name[32];
+    snprintf(name, sizeof(name), "/%016llx.bin", key);
+    return shader_cache_dir+string(name);
+}
+
+bool loadCachedProgram(GLuint program,unsigned long long key)
+{
+    string blob=readFile(shaderCachePath(key).c_str(), false);
+    if(blob.size()<=sizeof(GLenum))
+        return false;
+    GLenum format;
+    memcpy(&format, &blob[0], sizeof(format));
+    glProgramBinary(program, format, &blob[sizeof(format)], blob.size()-sizeof(format));
+    GLint linked=GL_FALSE;
+    glGetProgramiv(program, GL_LINK_STATUS, &linked);
+    return linked==GL_TRUE;     // a driver may refuse an old binary, then we just compile
+}
+
+void saveCachedProgram(GLuint program,unsigned long long key)
+{
+    GLint length=0;
+    glGetProgramiv(program, GL_PROGRAM_BINARY_LENGTH, &length);
+    if(length<=0)
+        return;
+    vector<char> blob(sizeof(GLenum)+length);
+    GLenum format;
+    glGetProgramBinary(program, length, NULL, &format, &blob[sizeof(format)]);
+    memcpy(&blob[0], &format, sizeof(format));
+    mkdir(shader_cache_dir, 0755);
+    string path=shaderCachePath(key), tmp=path+".tmp";
+    FILE *out=fopen(tmp.c_str(), "wb");
+    if(!out)
+        return;
+    bool ok=fwrite(&blob[0], blob.size(), 1, out)==1;
+    ok=fclose(out)==0&&ok;
+    if(ok)
+        rename(tmp.c_str(), path.c_str());
+    else
+        unlink(tmp.c_str());
+}
+
+/* Print an info log only when the driver has something to say */
+void printShaderLog(GLuint shader,const char *path)
+{
+    GLint length=0;
+    glGetShaderiv(shader, GL_INFO_LOG_LENGTH, &length);
+    if(length<=1)
+        return;
+    vector<char> log(length);
+    glGetShaderInfoLog(shader, length, NULL, &log[0]);
+    fprintf(stdout, "%s:\n%s\n", path, &log[0]);
+}
+void printProgramLog(GLuint program,const char *vertex_path,const char *fragment_path)
+{
+    GLint length=0;
+    glGetProgramiv(program, GL_INFO_LOG_LENGTH, &length);
+    if(length<=1)
+        return;
+    vector<char> log(length);
+    glGetProgramInfoLog(program, length, NULL, &log[0]);
+    fprintf(stdout, "%s + %s:\n%s\n", vertex_path, fragment_path, &log[0]);
+}
 
-	// Check Fragment Shader
-	glGetShaderiv(FragmentShaderID, GL_COMPILE_STATUS, &Result);
-	glGetShaderiv(FragmentShaderID, GL_INFO_LOG_LENGTH, &InfoLogLength);
-	std::vector<char> FragmentShaderErrorMessage(InfoLogLength);
-	glGetShaderInfoLog(FragmentShaderID, InfoLogLength, NULL, &FragmentShaderErrorMessage[0]);
-	fprintf(stdout, "%s\n", &FragmentShaderErrorMessage[0]);
+/* Let the driver compile on as many threads as it likes; without
+   ARB_parallel_shader_compile compiles still overlap on drivers that defer them */
+void initShaderCompiler()
+{
+    if(GLAD_GL_ARB_parallel_shader_compile)
+        glMaxShaderCompilerThreadsARB(0xFFFFFFFF);
+}
 
-	// Link the program
-	fprintf(stdout, "Linking program\n");
-	GLuint ProgramID = glCreateProgram();
-	glAttachShader(ProgramID, VertexShaderID);
-	glAttachShader(ProgramID, FragmentShaderID);
-	glLinkProgram(ProgramID);
+/* Start building a program: from the cache if we can, otherwise compile and
+   link without waiting for the result. Call finishProgram before using it */
+shaderProgram requestProgram(const char *vertex_file_path,const char *fragment_file_path)
+{
+    shaderProgram p={glCreateProgram(), 0, 0, vertex_file_path, fragment_file_path, 0};
+    string VertexShaderCode=readFile(vertex_file_path);
+    string FragmentShaderCode=readFile(fragment_file_path);
+
+    bool cache=programBinaries();
+    if(cache){
+        p.key=hashBytes(VertexShaderCode.c_str(), VertexShaderCode.size()+1);
+        p.key=hashBytes(FragmentShaderCode.c_str(), FragmentShaderCode.size()+1, p.key);
+        GLenum driver[3]={GL_VENDOR, GL_RENDERER, GL_VERSION};
+        for(int i=0;i<3;i++){
+            const char *name=(const char *)glGetString(driver[i]);
+            p.key=hashBytes(name, strlen(name)+1, p.key);
+        }
+        if(loadCachedProgram(p.id, p.key))
+            return p;
+        glProgramParameteri(p.id, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE);
+    }
 
-	// Check the program
-	glGetProgramiv(ProgramID, GL_LINK_STATUS, &Result);
-	glGetProgramiv(ProgramID, GL_INFO_LOG_LENGTH, &InfoLogLength);
-	std::vector<char> ProgramErrorMessage( max(InfoLogLength, int(1)) );
-	glGetProgramInfoLog(ProgramID, InfoLogLength, NULL, &ProgramErrorMessage[0]);
-	fprintf(stdout, "%s\n", &ProgramErrorMessage[0]);
+	char const * VertexSourcePointer = VertexShaderCode.c_str();
+	char const * FragmentSourcePointer = FragmentShaderCode.c_str();
+	p.vertex = glCreateShader(GL_VERTEX_SHADER);
+	p.fragment = glCreateShader(GL_FRAGMENT_SHADER);
+	glShaderSource(p.vertex, 1, &VertexSourcePointer , NULL);
+	glShaderSource(p.fragment, 1, &FragmentSourcePointer , NULL);
+	glCompileShader(p.vertex);
+	glCompileShader(p.fragment);
+
+	glAttachShader(p.id, p.vertex);
+	glAttachShader(p.id, p.fragment);
+	glLinkProgram(p.id);
+	return p;
+}
 
-	glDeleteShader(VertexShaderID);
-	glDeleteShader(FragmentShaderID);
+/* Wait for the program if needed, report problems and store it in the cache */
+GLuint finishProgram(shaderProgram &p)
+{
+    if(!p.vertex)
+        return p.id;
+    GLint Result = GL_FALSE;
+	glGetProgramiv(p.id, GL_LINK_STATUS, &Result);
+	printShaderLog(p.vertex, p.vertex_path);
+	printShaderLog(p.fragment, p.fragment_path);
+	printProgramLog(p.id, p.vertex_path, p.fragment_path);
+	if(Result==GL_TRUE&&p.key)
+	    saveCachedProgram(p.id, p.key);
+	else if(Result!=GL_TRUE)
+	    fprintf(stderr, "Linking %s + %s failed\n", p.vertex_path, p.fragment_path);
+
+	glDetachShader(p.id, p.vertex);
+	glDetachShader(p.id, p.fragment);
+	glDeleteShader(p.vertex);
+	glDeleteShader(p.fragment);
+	p.vertex=p.fragment=0;
+	return p.id;
+}
 
-	return ProgramID;
+/* Function to load Shaders - Use it as it is */
+GLuint LoadShaders(const char * vertex_file_path,const char * fragment_file_path) {
+    shaderProgram p=requestProgram(vertex_file_path, fragment_file_path);
+    return finishProgram(p);
 }
 
 static void error_callback(int error, const char* description)
@@ -115,10 +518,83 @@ static void error_callback(int error, const char* description)
     fprintf(stderr, "Error: %s\n", description);
 }
 
+/* Input recording (.rec): this header, then one inputFileEvent per key press or
+   release. count and ticks are filled in when the recording is closed */
+const int input_version = 1;
+typedef struct inputFileHeader
+{
+        char magic[4];
+        int version;
+        unsigned int seed;
+        int count;
+        long long ticks;    // simulation steps the session ran for
+        char level[256];
+}inputFileHeader;
+typedef struct inputFileEvent
+{
+        int tick;           // simulation step the event is applied before
+        short key;
+        short action;
+}inputFileEvent;
+
+/* Simulation steps run so far */
+long long sim_tick = 0;
+
+typedef struct recorder
+{
+    FILE *out;
+    const char *path;
+    inputFileHeader header;
+}recorder;
+recorder input_rec = {NULL, NULL};
+
+void startRecording(const char *path,unsigned int seed,const char *level_file)
+{
+    input_rec.out=fopen(path, "wb");
+    if(!input_rec.out){
+        fprintf(stderr, "Cannot write input recording %s\n", path);
+        exit(EXIT_FAILURE);
+    }
+    input_rec.path=path;
+    inputFileHeader &h=input_rec.header;
+    memset(&h, 0, sizeof(h));
+    memcpy(h.magic, "LVR1", 4);
+    h.version=input_version;
+    h.seed=seed;
+    strncpy(h.level, level_file, sizeof(h.level)-1);
+    fwrite(&h, sizeof(h), 1, input_rec.out);
+}
+
+void recordKey(int key,int action)
+{
+    if(!input_rec.out||(action!=GLFW_PRESS&&action!=GLFW_RELEASE))
+        return;
+    inputFileEvent e={(int)sim_tick, (short)key, (short)action};
+    fwrite(&e, sizeof(e), 1, input_rec.out);
+    input_rec.header.count++;
+}
+
+/* Patch the header with the final counts and close the file */
+void stopRecording()
+{
+    if(!input_rec.out)
+        return;
+    input_rec.header.ticks=sim_tick;
+    fseek(input_rec.out, 0, SEEK_SET);
+    fwrite(&input_rec.header, sizeof(input_rec.header), 1, input_rec.out);
+    fclose(input_rec.out);
+    input_rec.out=NULL;
+    printf("recorded %d key events over %lld steps to %s\n", input_rec.header.count, input_rec.header.ticks, input_rec.path);
+}
+
 void quit(GLFWwindow *window)
 {
-    glfwDestroyWindow(window);
-    glfwTerminate();
+    writeProfile();
+    stopRecording();
+    if(!headless&&!offscreen){
+        glfwDestroyWindow(window);
+        glfwTerminate();
+    }
     exit(EXIT_SUCCESS);
 }
 
@@ -130,6 +606,8 @@ struct VAO* create3DObject (GLenum primitive_mode, int numVertices, const GLfloa
     vao->PrimitiveMode = primitive_mode;
     vao->NumVertices = numVertices;
     vao->FillMode = fill_mode;
+    vao->IndexBuffer = 0;
+    vao->NumIndices = 0;
 
     // Create Vertex Array Object
     // Should be done after CreateWindow and before any other GL calls
@@ -137,8 +615,8 @@ struct VAO* create3DObject (GLenum primitive_mode, int numVertices, const GLfloa
     glGenBuffers (1, &(vao->VertexBuffer)); // VBO - vertices
     glGenBuffers (1, &(vao->ColorBuffer));  // VBO - colors
 
-    glBindVertexArray (vao->VertexArrayID); // Bind the VAO 
-    glBindBuffer (GL_ARRAY_BUFFER, vao->VertexBuffer); // Bind the VBO vertices 
+    bindVertexArray (vao->VertexArrayID); // Bind the VAO 
+    bindArrayBuffer (vao->VertexBuffer); // Bind the VBO vertices 
     glBufferData (GL_ARRAY_BUFFER, 3*numVertices*sizeof(GLfloat), vertex_buffer_data, GL_STATIC_DRAW); // Copy the vertices into VBO
     glVertexAttribPointer(
                           0,                  // attribute 0. Vertices
@@ -148,8 +626,9 @@ struct VAO* create3DObject (GLenum primitive_mode, int numVertices, const GLfloa
                           0,                  // stride
                           (void*)0            // array buffer offset
                           );
+    glEnableVertexAttribArray(0);
 
-    glBindBuffer (GL_ARRAY_BUFFER, vao->ColorBuffer); // Bind the VBO colors 
+    bindArrayBuffer (vao->ColorBuffer); // Bind the VBO colors 
     glBufferData (GL_ARRAY_BUFFER, 3*numVertices*sizeof(GLfloat), color_buffer_data, GL_STATIC_DRAW);  // Copy the vertex colors
     glVertexAttribPointer(
                           1,                  // attribute 1. Color
@@ -159,7 +638,97 @@ struct VAO* create3DObject (GLenum primitive_mode, int numVertices, const GLfloa
                           0,                  // stride
                           (void*)0            // array buffer offset
                           );
+    glEnableVertexAttribArray(1);
+
+    return vao;
+}
+
+/* Round a float to the nearest half float */
+GLhalf toHalf(float f)
+{
+    unsigned int x;
+    memcpy(&x, &f, sizeof(x));
+    unsigned int sign = (x>>16)&0x8000, m = x&0x7fffff;
+    int e = (int)((x>>23)&0xff)-127+15;
+    if (e >= 31)
+        return sign|0x7c00;     // too big for a half: infinity
+    int shift = 13;
+    if (e <= 0) {
+        // subnormal half: shift the implicit bit in too
+        if (e < -10)
+            return sign;
+        m |= 0x800000;
+        shift = 14-e;
+        e = 0;
+    }
+    unsigned int h = ((unsigned int)e<<10)|(m>>shift);
+    unsigned int rest = m&((1u<<shift)-1), halfway = 1u<<(shift-1);
+    if (rest > halfway || (rest == halfway && (h&1)))
+        h++;    // a carry into the exponent is still the right answer
+    return sign|h;
+}
+packedVertex packVertex(const GLfloat* position, const GLfloat* color)
+{
+    packedVertex v;
+    v.x = toHalf(position[0]);
+    v.y = toHalf(position[1]);
+    v.z = toHalf(position[2]);
+    v.pad = 0;
+    v.r = (GLubyte)(color[0]*255+0.5f);
+    v.g = (GLubyte)(color[1]*255+0.5f);
+    v.b = (GLubyte)(color[2]*255+0.5f);
+    v.a = 255;
+    return v;
+}
+
+/* Point attributes 0 (position) and 1 (color) of the bound VAO at the mesh's buffers */
+void bindMeshAttributes (struct VAO* mesh)
+{
+    bindArrayBuffer (mesh->VertexBuffer);
+    if (mesh->ColorBuffer) {
+        glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, 0, (void*)0);
+        bindArrayBuffer (mesh->ColorBuffer);
+        glVertexAttribPointer(1, 3, GL_FLOAT, GL_FALSE, 0, (void*)0);
+    }
+    else {
+        glVertexAttribPointer(0, 3, GL_HALF_FLOAT, GL_FALSE, sizeof(packedVertex), (void*)offsetof(packedVertex, x));
+        glVertexAttribPointer(1, 4, GL_UNSIGNED_BYTE, GL_TRUE, sizeof(packedVertex), (void*)offsetof(packedVertex, r));
+    }
+    glEnableVertexAttribArray(0);
+    glEnableVertexAttribArray(1);
+    if (mesh->IndexBuffer)
+        glBindBuffer (GL_ELEMENT_ARRAY_BUFFER, mesh->IndexBuffer);
+}
 
+/* Generate VAO, interleaved VBO and index buffer and return VAO handle; indices are
+   stored as 16 bit when the vertices allow it */
+struct VAO* createIndexedObject (GLenum primitive_mode, const vector<packedVertex> &vertices, const vector<GLuint> &indices, GLenum fill_mode=GL_FILL)
+{
+    struct VAO* vao = new struct VAO;
+    vao->PrimitiveMode = primitive_mode;
+    vao->FillMode = fill_mode;
+    vao->NumVertices = vertices.size();
+    vao->NumIndices = indices.size();
+    vao->ColorBuffer = 0;
+
+    glGenVertexArrays(1, &(vao->VertexArrayID));
+    glGenBuffers (1, &(vao->VertexBuffer));
+    glGenBuffers (1, &(vao->IndexBuffer));
+    bindVertexArray (vao->VertexArrayID);
+
+    bindArrayBuffer (vao->VertexBuffer);
+    glBufferData (GL_ARRAY_BUFFER, vertices.size()*sizeof(packedVertex), vertices.data(), GL_STATIC_DRAW);
+    glBindBuffer (GL_ELEMENT_ARRAY_BUFFER, vao->IndexBuffer);
+    if (vertices.size() <= 65536) {
+        vector<GLushort> shortIndices(indices.begin(), indices.end());
+        vao->IndexType = GL_UNSIGNED_SHORT;
+        glBufferData (GL_ELEMENT_ARRAY_BUFFER, shortIndices.size()*sizeof(GLushort), shortIndices.data(), GL_STATIC_DRAW);
+    }
+    else {
+        vao->IndexType = GL_UNSIGNED_INT;
+        glBufferData (GL_ELEMENT_ARRAY_BUFFER, indices.size()*sizeof(GLuint), indices.data(), GL_STATIC_DRAW);
+    }
+    bindMeshAttributes(vao);
     return vao;
 }
 
@@ -173,31 +742,276 @@ struct VAO* create3DObject (GLenum primitive_mode, int numVertices, const GLfloa
         color_buffer_data [3*i + 2] = blue;
     }
 
-    return create3DObject(primitive_mode, numVertices, vertex_buffer_data, color_buffer_data, fill_mode);
+    struct VAO* vao = create3DObject(primitive_mode, numVertices, vertex_buffer_data, color_buffer_data, fill_mode);
+    // glBufferData has copied the colors to the GPU, so the array is no longer needed
+    delete [] color_buffer_data;
+    return vao;
 }
 
 /* Render the VBOs handled by VAO */
 void draw3DObject (struct VAO* vao)
 {
     // Change the Fill Mode for this object
-    glPolygonMode (GL_FRONT_AND_BACK, vao->FillMode);
+    setFillMode (vao->FillMode);
 
-    // Bind the VAO to use
-    glBindVertexArray (vao->VertexArrayID);
+    // Bind the VAO to use; the enabled attributes and their buffers are part of it
+    bindVertexArray (vao->VertexArrayID);
 
-    // Enable Vertex Attribute 0 - 3d Vertices
-    glEnableVertexAttribArray(0);
-    // Bind the VBO to use
-    glBindBuffer(GL_ARRAY_BUFFER, vao->VertexBuffer);
+    // Draw the geometry !
+    if (vao->IndexBuffer)
+        glDrawElements(vao->PrimitiveMode, vao->NumIndices, vao->IndexType, (void*)0);
+    else
+        glDrawArrays(vao->PrimitiveMode, 0, vao->NumVertices); // Starting from vertex 0; 3 vertices total -> 1 triangle
+    profile.current.drawCalls++;
+}
 
-    // Enable Vertex Attribute 1 - Color
-    glEnableVertexAttribArray(1);
-    // Bind the VBO to use
-    glBindBuffer(GL_ARRAY_BUFFER, vao->ColorBuffer);
+/* Free the buffers of a VAO made by create3DObject */
+void delete3DObject (struct VAO* vao)
+{
+    if (!vao)
+        return;
+    glDeleteBuffers (1, &vao->VertexBuffer);
+    glDeleteBuffers (1, &vao->ColorBuffer);
+    glDeleteBuffers (1, &vao->IndexBuffer);
+    glDeleteVertexArrays (1, &vao->VertexArrayID);
+    forgetGLState();    // deleting what is bound unbinds it
+    delete vao;
+}
 
-    // Draw the geometry !
-    glDrawArrays(vao->PrimitiveMode, 0, vao->NumVertices); // Starting from vertex 0; 3 vertices total -> 1 triangle
+/* Many copies of one mesh drawn with a single instanced call */
+struct instanceBatch {
+    GLuint VertexArrayID;
+    GLuint OffsetBuffer;    // VBO - one position and scale per instance
+
+    struct VAO* mesh;
+    int capacity;
+    vector<GLfloat> offsets; // copy of what the GPU buffer holds
+};
+typedef struct instanceBatch instanceBatch;
+
+/* Generate a VAO that reuses the mesh's VBOs and adds a per-instance offset at attribute 2:
+   xyz is where the copy sits, w scales it (0 hides it) */
+void createInstanceBatch (instanceBatch* batch, struct VAO* mesh, int capacity)
+{
+    batch->mesh = mesh;
+    batch->capacity = capacity;
+    batch->offsets.clear();
+
+    glGenVertexArrays(1, &(batch->VertexArrayID));
+    glGenBuffers (1, &(batch->OffsetBuffer));
+
+    bindVertexArray (batch->VertexArrayID);
+    bindMeshAttributes(mesh);
+
+    bindArrayBuffer (batch->OffsetBuffer);
+    glBufferData (GL_ARRAY_BUFFER, 4*capacity*sizeof(GLfloat), NULL, GL_DYNAMIC_DRAW);
+    glVertexAttribPointer(2, 4, GL_FLOAT, GL_FALSE, 0, (void*)0);
+    glEnableVertexAttribArray(2);
+    glVertexAttribDivisor(2, 1); // advance once per instance, not per vertex
+}
+
+/* Upload instance offsets (4 floats each), sending only the runs that differ from last time */
+void updateInstanceBatch (instanceBatch* batch, const vector<GLfloat> &offsets)
+{
+    int count = offsets.size()/4;
+    bindArrayBuffer (batch->OffsetBuffer);
+    if (count > batch->capacity || offsets.size() != batch->offsets.size()) {
+        // Number of instances changed, so everything moved: upload the whole buffer
+        batch->capacity = max(count, batch->capacity);
+        glBufferData (GL_ARRAY_BUFFER, 4*batch->capacity*sizeof(GLfloat), NULL, GL_DYNAMIC_DRAW);
+        glBufferSubData (GL_ARRAY_BUFFER, 0, offsets.size()*sizeof(GLfloat), offsets.data());
+        batch->offsets = offsets;
+        return;
+    }
+    for (int i=0; i<count; ) {
+        if (!memcmp(&offsets[4*i], &batch->offsets[4*i], 4*sizeof(GLfloat))) {
+            i++;
+            continue;
+        }
+        int start = i;
+        while (i<count && memcmp(&offsets[4*i], &batch->offsets[4*i], 4*sizeof(GLfloat)))
+            i++;
+        glBufferSubData (GL_ARRAY_BUFFER, 4*start*sizeof(GLfloat), 4*(i-start)*sizeof(GLfloat), &offsets[4*start]);
+        copy(offsets.begin()+4*start, offsets.begin()+4*i, batch->offsets.begin()+4*start);
+    }
+}
+
+/* Render instances [first,first+count) of the batch, instancedProgramID must be in use */
+void drawInstanceRange (instanceBatch* batch, int first, int count)
+{
+    setFillMode (batch->mesh->FillMode);
+    bindVertexArray (batch->VertexArrayID);
+    // start the per-instance attribute at the first instance wanted
+    bindArrayBuffer (batch->OffsetBuffer);
+    glVertexAttribPointer(2, 4, GL_FLOAT, GL_FALSE, 0, (void*)(4*first*sizeof(GLfloat)));
+    if (batch->mesh->IndexBuffer)
+        glDrawElementsInstanced(batch->mesh->PrimitiveMode, batch->mesh->NumIndices, batch->mesh->IndexType, (void*)0, count);
+    else
+        glDrawArraysInstanced(batch->mesh->PrimitiveMode, 0, batch->mesh->NumVertices, count);
+    profile.current.drawCalls++;
+}
+
+/* Draw mesh with model matrix frameTransforms[transform]; the program using the ring must be in use */
+void drawTransformed(struct VAO* mesh,int transform)
+{
+    selectTransform(transform);
+    profile.current.uniformUploads++;
+    draw3DObject(mesh);
+}
+
+/* A draw of the frame, queued so draws sharing state can be sent one after another */
+typedef struct drawItem
+{
+    GLuint program;
+    struct VAO* mesh;
+    int transform;      // index into frameTransforms
+}drawItem;
+vector<drawItem> frameDraws;
+
+/* Queue mesh to be drawn by program with model matrix model */
+void queueDraw(GLuint program,struct VAO* mesh,const glm::mat4 &model)
+{
+    drawItem d={program, mesh, (int)frameTransforms.size()};
+    frameDraws.push_back(d);
+    frameTransforms.push_back(model);
+}
+bool drawOrder(const drawItem &a,const drawItem &b)
+{
+    if(a.program!=b.program)
+        return a.program<b.program;
+    // the ring window the matrix is in, so each is bound once per program
+    if(a.transform/transform_window!=b.transform/transform_window)
+        return a.transform/transform_window<b.transform/transform_window;
+    if(a.mesh->FillMode!=b.mesh->FillMode)
+        return a.mesh->FillMode<b.mesh->FillMode;
+    if(a.mesh->VertexArrayID!=b.mesh->VertexArrayID)
+        return a.mesh->VertexArrayID<b.mesh->VertexArrayID;
+    return a.transform<b.transform;
+}
+/* Draw the queue sorted by program, ring window, fill mode and mesh; uploadTransforms must have run */
+void submitDraws()
+{
+    sort(frameDraws.begin(), frameDraws.end(), drawOrder);
+    for(int k=0;k<frameDraws.size();k++)
+    {
+        useProgram(frameDraws[k].program);
+        drawTransformed(frameDraws[k].mesh, frameDraws[k].transform);
+    }
+}
+
+/* Worker pool for the simulation. runJobs(count, job) calls job(k) for every k in
+   [0,count) on the workers and the calling thread and returns once all are done.
+   A job only writes its own slice of the output and anything order dependent is
+   applied afterwards on the calling thread, so results never depend on the thread count */
+typedef struct jobPool
+{
+    vector<std::thread> workers;
+    std::mutex lock;
+    std::condition_variable wake, finished;
+    std::function<void(int)> job;
+    int count, next, done;
+    unsigned int batch;     // bumped by every runJobs, so a waking worker can tell there is work
+    bool stop;
+}jobPool;
+jobPool jobs;
+int job_threads = 1;        // including the calling thread
+
+void jobWorker()
+{
+    unsigned int seen=0;
+    std::unique_lock<std::mutex> hold(jobs.lock);
+    while(true)
+    {
+        jobs.wake.wait(hold, [&seen](){ return jobs.stop||jobs.batch!=seen; });
+        if(jobs.stop)
+            return;
+        seen=jobs.batch;
+        while(jobs.next<jobs.count)
+        {
+            int k=jobs.next++;
+            hold.unlock();
+            jobs.job(k);
+            hold.lock();
+            if(++jobs.done==jobs.count)
+                jobs.finished.notify_one();
+        }
+    }
+}
+
+void stopJobs()
+{
+    {
+        std::lock_guard<std::mutex> hold(jobs.lock);
+        jobs.stop=true;
+    }
+    jobs.wake.notify_all();
+    for(int k=0;k<jobs.workers.size();k++)
+        jobs.workers[k].join();
+    jobs.workers.clear();
+    job_threads=1;
+}
+
+/* Run jobs on threads threads in all, the calling one included */
+void startJobs(int threads)
+{
+    static bool registered=false;
+    if(!registered)
+        atexit(stopJobs);   // the workers have to be joined before exit
+    registered=true;
+
+    stopJobs();
+    jobs.stop=false;
+    jobs.count=jobs.next=jobs.done=0;
+    job_threads=max(threads,1);
+    for(int k=1;k<job_threads;k++)
+        jobs.workers.push_back(std::thread(jobWorker));
+}
+
+void runJobs(int count,const std::function<void(int)> &job)
+{
+    if(jobs.workers.empty()||count<=1)
+    {
+        for(int k=0;k<count;k++)
+            job(k);
+        return;
+    }
+    std::unique_lock<std::mutex> hold(jobs.lock);
+    jobs.job=job;
+    jobs.count=count;
+    jobs.next=jobs.done=0;
+    jobs.batch++;
+    jobs.wake.notify_all();
+    while(jobs.next<jobs.count)
+    {
+        int k=jobs.next++;
+        hold.unlock();
+        job(k);
+        hold.lock();
+        jobs.done++;
+    }
+    jobs.finished.wait(hold, [](){ return jobs.done==jobs.count; });
+}
+
+/* How many slices to cut n items into: a few per thread, but none smaller than grain.
+   Fewer than two grains' worth is one slice, which runJobs runs on the calling thread */
+int sliceCount(int n,int grain)
+{
+    if(job_threads==1||n<2*grain)
+        return 1;
+    return min(job_threads*4,n/grain);
+}
+/* First item of slice k of n items cut into slices; slice k ends where k+1 starts */
+int sliceStart(int n,int slices,int k)
+{
+    return (long long)n*k/slices;
 }
+/* Fewest tiles or bodies worth handing to another thread: waking a worker costs several
+   microseconds, so a slice has to hold tens of microseconds of work (a body is 0.25-2us).
+   Collision is split by body and never within one: a body's query is the few tiles in the
+   cells around it, far less than a wake-up. The game steps the player alone, so its
+   collision always runs inline and only crowds of bodies (the bench) use the pool */
+const int tile_grain = 4096;
+const int body_grain = 256;
 
 /**************************
  * Customizable functions *
@@ -208,6 +1022,10 @@ float rectangle_rot_dir = 1;
 bool triangle_rot_status = true;
 bool rectangle_rot_status = true;
 float Floor_limit=-2;
+/* Every random choice in the game comes from here, so a seed fixes a whole run */
+std::mt19937 rng(1);
+/* Draw the floor with one instanced call instead of one call per tile */
+bool instanced=true;
 typedef struct eye
 {
     float x,y,z;
@@ -220,6 +1038,7 @@ typedef struct object
         struct VAO* sprite;
         float posx,posy,posz;
         float x,y,z;
+        float lastx,lasty,lastz;
         float vx,vy,vz;
         float radius;
         float mass;
@@ -228,14 +1047,104 @@ typedef struct object
         bool on_platform;
 }object;
 object player;
-vector <object> flor;
 vector <object> obstacle;
 
-
-void moveTile(object *);
+enum { BOBBING_TILE, SLIDING_TILE, STATIC_TILE };
+/* The floor tiles, kept as one array per field so the per-step loops only
+   stream through the fields they use. Tile i is element i of every array.
+   Moving tiles are kept at the front: [0,bobbing) bob up and down and
+   [bobbing,bobbing+sliding) slide, each coordinate turning around when it
+   leaves its [lo,hi] range.
+   A tile's index is its handle and never changes once the level is built:
+   removing a tile only marks its slot dead and puts it on the free list. */
+typedef struct tileStore
+{
+        int n;
+        int bobbing,sliding;
+        struct VAO* sprite;     // every tile is drawn with this mesh
+        vector<float> posx,posy,posz;
+        vector<float> x,y,z;
+        vector<float> lastx,lasty,lastz;
+        vector<float> vx,vy,vz;
+        vector<float> size;
+        vector<float> lox,hix,loy,hiy,loz,hiz;
+        vector<int> kind;
+        vector<int> cellx,cellz;
+        vector<unsigned char> alive;
+        vector<int> chunk;      // index into chunks
+        vector<int> crumble;    // steps left before a crumbling tile falls, 0 - not started, -1 - solid tile
+        vector<int> source;     // index of a streamed tile in the compiled level, -1 otherwise
+        vector<int> freeSlots;
+}tileStore;
+tileStore flor;
+/* Half size of every tile in a level file */
+const float level_tile_size = 0.5;
+
+/* Extent of the loaded level; sliding tiles turn around at its edges */
+typedef struct levelInfo
+{
+        float minx,maxx,minz,maxz;
+        float floory;
+}levelInfo;
+levelInfo level;
+const char *level_path = "level1.lvl";
+
+/* Uniform grid over the floor, keyed on integer tile coordinates (x,z).
+   Each cell holds the indices of the tiles whose centre lies in it: static tiles
+   first, then moving ones in the order they came in. Contacts are resolved in this
+   order, so it must not depend on when a streamed chunk happened to be put in */
+typedef struct tileGrid
+{
+        unordered_map<long long, vector<int> > cells;
+        float maxSize;
+}tileGrid;
+tileGrid grid;
+/* The floor split into chunk_size x chunk_size blocks of cells for culling. Inside each
+   motion group tiles are sorted by chunk, so a chunk owns a few runs of slots */
+const int chunk_size = 8;
+typedef struct tileChunk
+{
+        int cx,cz;
+        glm::vec3 lo,hi;                // holds every tile of the chunk wherever it moves
+        vector<pair<int,int> > ranges;  // [begin,end) runs of tile slots
+        struct VAO* baked;              // the static tiles merged into one mesh, NULL if none
+        glm::vec3 origin;               // baked holds positions relative to this, to keep half floats exact
+        bool dirty;                     // baked is out of date
+}tileChunk;
+vector <tileChunk> chunks;
+unordered_map<long long,int> chunkIndex;    // gridKey(cx,cz) -> index into chunks
+/* What culling did in the last frame */
+typedef struct cullStats
+{
+        int chunksDrawn,chunksCulled;
+        int tilesDrawn,tilesCulled;
+}cullStats;
+cullStats cullCount;
+/* Chunks further than this from the player are not drawn even if they are in view */
+float draw_distance = 50;
+/* Chunks whose static tiles changed that are baked again per frame, nearest first; the
+   others keep drawing their old mesh until their turn */
+int bake_budget = 4;
+/* Load every chunk as soon as it is needed and bake every chunk drawn, so frames come
+   out the same on every run (--png) */
+bool exact_frames = false;
+vector <pair<int,int> > visibleRanges;  // moving tiles to draw one by one or instanced
+vector <int> visibleChunks;             // chunks whose baked static tiles are drawn
+
+/* Crumbling tiles that were stepped on and are counting down */
+vector <int> crumbling;
+/* How many steps a crumbling tile holds after it is first touched */
+const int crumble_steps = 30;
+
+
+void moveTile(int);
 bool checkFloor(object *);
-void deleteTiles();
-void slideBlock(object *,int);
+void slideBlock(int,int);
+void buildGrid();
+void buildChunks();
+int chunkOf(float);
+void gridUpdate(int);
+void savePosition(object *);
 /* Executed when a regular key is pressed/released/held-down */
 /* Prefered for Keyboard events */
 
@@ -272,6 +1181,10 @@ void keyboard (GLFWwindow* window, int key, int scancode, int action, int mods)
 {
      // Function is called first on GLFW_PRESS.
 
+    // escape ends the session, so a replay just stops at the recorded length instead
+    if (window && key != GLFW_KEY_ESCAPE)
+        recordKey(key, action);
+
     if (action == GLFW_RELEASE) {
         switch (key) {
             case GLFW_KEY_C:
@@ -327,6 +1240,9 @@ void keyboard (GLFWwindow* window, int key, int scancode, int action, int mods)
             case GLFW_KEY_V:
                 camera.state ^= 1;
                 break;
+            case GLFW_KEY_I:
+                instanced = !instanced;
+                break;
             
 
             default:
@@ -345,7 +1261,9 @@ void reshapeWindow (GLFWwindow* window, int width, int height)
     int fbwidth=width, fbheight=height;
     /* With Retina display on Mac OS X, GLFW's FramebufferSize
      is different from WindowSize */
-    glfwGetFramebufferSize(window, &fbwidth, &fbheight);
+    if(window){
+        glfwGetFramebufferSize(window, &fbwidth, &fbheight);
+    }
 
 	GLfloat fov = 90.0f;
 
@@ -365,69 +1283,478 @@ void reshapeWindow (GLFWwindow* window, int width, int height)
 }
 
 
-void gravity(object *b)
+int gridCell(float v)
 {
-    int val=b->vy;
-    b->y+=b->vy;
-    if(checkFloor(&player))
-    {
-        b->y-=val;
-        b->y+=b->vy;
-    }
-    
-    b->vy*=0.95;
-    b->vy-=0.02;
-    b->x+=b->vx;
-    b->z+=b->vz;
-            
+    return (int)floor(v+0.5f);
 }
-bool checkFloor(object *b)
+long long gridKey(int cx,int cz)
 {
-    bool flag =false;
-    for(int i=0;i<flor.size();i++)
-    {
-        object f;
-        f=flor[i];
-        if(abs(b->x-f.x)<f.size+b->size)
+    return ((long long)cx<<32)^(unsigned int)cz;
+}
+void gridInsert(int i)
+{
+    flor.cellx[i]=gridCell(flor.x[i]);
+    flor.cellz[i]=gridCell(flor.z[i]);
+    vector<int> &cell=grid.cells[gridKey(flor.cellx[i],flor.cellz[i])];
+    int moving=flor.bobbing+flor.sliding, k=cell.size();
+    if(i>=moving)
+        while(k>0&&cell[k-1]<moving)
+            k--;
+    cell.insert(cell.begin()+k,i);
+    if(flor.size[i]>grid.maxSize)
+        grid.maxSize=flor.size[i];
+}
+void gridRemove(int i)
+{
+    unordered_map<long long, vector<int> >::iterator it=grid.cells.find(gridKey(flor.cellx[i],flor.cellz[i]));
+    if(it==grid.cells.end())
+        return;
+    vector<int> &cell=it->second;
+    vector<int>::iterator at=find(cell.begin(),cell.end(),i);
+    if(at!=cell.end())
+        cell.erase(at);
+    if(cell.empty())
+        grid.cells.erase(it);
+}
+/* Call after changing a tile's x or z; only touches the grid when it crossed into another cell */
+void gridUpdate(int i)
+{
+    if(gridCell(flor.x[i])==flor.cellx[i]&&gridCell(flor.z[i])==flor.cellz[i])
+        return;
+    gridRemove(i);
+    gridInsert(i);
+}
+/* Rebuild every cell, needed whenever the tiles are reordered */
+void buildGrid()
+{
+    grid.cells.clear();
+    grid.maxSize=0;
+    for(int i=0;i<flor.n;i++)
+        if(flor.alive[i])
+            gridInsert(i);
+}
+/* Collect the tiles whose cell can hold a tile overlapping a box of half size r at (x,z) */
+void queryGrid(float x,float z,float r,vector<int> &out)
+{
+    out.clear();
+    float reach=r+grid.maxSize;
+    int x0=gridCell(x-reach),x1=gridCell(x+reach);
+    int z0=gridCell(z-reach),z1=gridCell(z+reach);
+    for(int cx=x0;cx<=x1;cx++)
+        for(int cz=z0;cz<=z1;cz++)
         {
-           // player.vx-=player.vx;
-            if(abs(b->y-f.y)<f.size+b->size){
-                    
-                    if(abs(b->z-f.z)<f.size+b->size){
-                      //  player.vz=-player.vz;
-                        if(abs(player.vx)>0&&abs(player.y-f.y)<0.5)
-                        {
-                            player.x+=(abs(player.x-f.x)/(player.x-f.x))*0.05;
-                            player.vx=0;
-                        }
-                        if(abs(player.vz)>0&&abs(player.y-f.y)<0.5)
-                        {
-                            player.z+=(abs(player.z-f.z)/(player.z-f.z))*0.05;
-                            player.vz=0;
-                        }
-                        if(abs(player.vy)>0&&abs(player.y-f.y)<1)
-                        {
-                            if(player.vy)
-                            player.y-=player.vy;
-                            player.vy=0;
-                        }
-                    flag = true;
-                    if(abs(flor[i].vy)!=0)
-                    { 
-                            player.vy=flor[i].vy;
-                    }
-                    if(abs(flor[i].vx)>0&&abs(player.vx)<0.01)
-                            player.vx=flor[i].vx;
-                    if(abs(flor[i].vz)>0&&abs(player.vz)<0.01)
-                            player.vz=flor[i].vz;
-                    }
-        
-                }
+            unordered_map<long long, vector<int> >::const_iterator it=grid.cells.find(gridKey(cx,cz));
+            if(it!=grid.cells.end())
+                out.insert(out.end(),it->second.begin(),it->second.end());
         }
+}
+int chunkOf(float v)
+{
+    int c=gridCell(v);
+    return c>=0?c/chunk_size:-((-c-1)/chunk_size)-1;
+}
+/* Grow [a,b] to hold a tile of half size s along one coordinate wherever it moves:
+   p is where it is, home where it started, it turns around one step v outside [lo,hi] */
+void extendSpan(float &a,float &b,float p,float home,float v,float lo,float hi,float s)
+{
+    a=min(a,min(p,home)-s);
+    b=max(b,max(p,home)+s);
+    if(lo>-FLT_MAX)
+        a=min(a,lo-fabsf(v)-s);
+    if(hi<FLT_MAX)
+        b=max(b,hi+fabsf(v)+s);
+}
+/* Grow a chunk's box to hold tile i over its whole range of motion */
+void extendChunk(tileChunk &c,int i)
+{
+    float s=flor.size[i];
+    extendSpan(c.lo.x,c.hi.x,flor.x[i],flor.posx[i],flor.vx[i],flor.lox[i],flor.hix[i],s);
+    extendSpan(c.lo.y,c.hi.y,flor.y[i],flor.posy[i],flor.vy[i],flor.loy[i],flor.hiy[i],s);
+    extendSpan(c.lo.z,c.hi.z,flor.z[i],flor.posz[i],flor.vz[i],flor.loz[i],flor.hiz[i],s);
+}
+void clearChunks()
+{
+    for(int c=0;c<chunks.size();c++)
+        delete3DObject(chunks[c].baked);
+    chunks.clear();
+    chunkIndex.clear();
+}
+/* Index of chunk (cx,cz), made empty if there is none yet */
+int chunkAt(int cx,int cz)
+{
+    unordered_map<long long,int>::iterator it=chunkIndex.find(gridKey(cx,cz));
+    if(it!=chunkIndex.end())
+        return it->second;
+    tileChunk c;
+    c.cx=cx;
+    c.cz=cz;
+    c.lo=glm::vec3(FLT_MAX);
+    c.hi=glm::vec3(-FLT_MAX);
+    c.baked=NULL;
+    c.dirty=true;
+    chunkIndex[gridKey(cx,cz)]=chunks.size();
+    chunks.push_back(c);
+    return chunks.size()-1;
+}
+/* Add slot i to a chunk's runs of slots, growing the last run if i follows it */
+void addToRanges(vector<pair<int,int> > &ranges,int i)
+{
+    if(!ranges.empty()&&ranges.back().second==i)
+        ranges.back().second++;
+    else
+        ranges.push_back(make_pair(i,i+1));
+}
+/* Take slot i out of a chunk's runs of slots, splitting the run it is in */
+void removeFromRanges(vector<pair<int,int> > &ranges,int i)
+{
+    for(int k=0;k<ranges.size();k++)
+    {
+        pair<int,int> r=ranges[k];
+        if(i<r.first||i>=r.second)
+            continue;
+        ranges.erase(ranges.begin()+k);
+        if(r.first<i)
+            ranges.push_back(make_pair(r.first,i));
+        if(i+1<r.second)
+            ranges.push_back(make_pair(i+1,r.second));
+        return;
     }
-    return flag;
 }
-VAO* createCube(float s,int color)
+/* Move tile i into the chunk at its starting place, out of the one it was in */
+void assignChunk(int i)
+{
+    int c=chunkAt(chunkOf(flor.posx[i]),chunkOf(flor.posz[i]));
+    if(flor.chunk[i]!=c)
+    {
+        if(flor.chunk[i]>=0)
+            removeFromRanges(chunks[flor.chunk[i]].ranges,i);
+        addToRanges(chunks[c].ranges,i);
+        flor.chunk[i]=c;
+    }
+    extendChunk(chunks[c],i);
+}
+/* Group the tiles into chunks by their starting place; a moving tile stays in its chunk */
+void buildChunks()
+{
+    clearChunks();
+    flor.chunk.assign(flor.n,-1);
+    for(int i=0;i<flor.n;i++)
+        assignChunk(i);
+}
+/* The baked mesh of a chunk has to be redone when its static tiles change, and so do
+   its neighbours' since faces against a tile that comes or goes are hidden or shown */
+void markChunkDirty(int cx,int cz)
+{
+    unordered_map<long long,int>::iterator it=chunkIndex.find(gridKey(cx,cz));
+    if(it!=chunkIndex.end())
+        chunks[it->second].dirty=true;
+}
+void markTileDirty(float x,float z)
+{
+    int cx=chunkOf(x),cz=chunkOf(z);
+    markChunkDirty(cx,cz);
+    markChunkDirty(chunkOf(x-1),cz);
+    markChunkDirty(chunkOf(x+1),cz);
+    markChunkDirty(cx,chunkOf(z-1));
+    markChunkDirty(cx,chunkOf(z+1));
+}
+/* hit[k] tells whether tile idx[k] overlaps the box of half size r centred at (x,y,z) */
+void overlapTiles(const int *idx,int count,float x,float y,float z,float r,unsigned char *hit)
+{
+    const float *tx=flor.x.data(), *ty=flor.y.data(), *tz=flor.z.data(), *ts=flor.size.data();
+    for(int k=0;k<count;k++)
+    {
+        int i=idx[k];
+        float reach=ts[i]+r;
+        hit[k]=(fabsf(x-tx[i])<reach)&(fabsf(y-ty[i])<reach)&(fabsf(z-tz[i])<reach);
+    }
+}
+/* A body touching a tile (narrowphase output) or a candidate pair (broadphase output) */
+typedef struct contact
+{
+    int body;
+    int tile;
+}contact;
+/* What one collision job works in, so jobs never share buffers */
+typedef struct collisionScratch
+{
+    vector<int> nearby;
+    vector<unsigned char> touching;
+    vector<contact> candidates, contacts;
+}collisionScratch;
+vector<collisionScratch> scratch;
+/* Bodies whose boxes overlap, as indices into the list being stepped */
+vector<pair<int,int> > bodyPairs;
+vector<int> sweepOrder;
+
+/* Broadphase: every tile in the grid cells around bodies [begin,end) */
+void broadphaseTiles(object **list,int begin,int end,vector<int> &nearby,vector<contact> &out)
+{
+    out.clear();
+    for(int b=begin;b<end;b++)
+    {
+        queryGrid(list[b]->x,list[b]->z,list[b]->size,nearby);
+        for(int k=0;k<nearby.size();k++)
+        {
+            contact c={b,nearby[k]};
+            out.push_back(c);
+        }
+    }
+}
+/* Narrowphase: keep the candidates whose boxes really overlap. Candidates come
+   grouped by body, so each group is tested in one batch */
+void narrowphaseTiles(object **list,const vector<contact> &pairs,vector<int> &nearby,vector<unsigned char> &touching,vector<contact> &out)
+{
+    out.clear();
+    nearby.resize(pairs.size());
+    touching.resize(pairs.size());
+    for(int k=0;k<pairs.size();k++)
+        nearby[k]=pairs[k].tile;
+    for(int start=0;start<pairs.size();)
+    {
+        int end=start;
+        while(end<pairs.size()&&pairs[end].body==pairs[start].body)
+            end++;
+        object *b=list[pairs[start].body];
+        overlapTiles(&nearby[start],end-start,b->x,b->y,b->z,b->size,&touching[start]);
+        start=end;
+    }
+    for(int k=0;k<pairs.size();k++)
+        if(touching[k])
+            out.push_back(pairs[k]);
+}
+/* Push body b out of tile i and let it ride along with the tile */
+void resolveTileContact(object *b,int i)
+{
+    float fx=flor.x[i],fy=flor.y[i],fz=flor.z[i];
+    if(abs(b->vx)>0&&abs(b->y-fy)<0.5)
+    {
+        b->x+=(abs(b->x-fx)/(b->x-fx))*0.05;
+        b->vx=0;
+    }
+    if(abs(b->vz)>0&&abs(b->y-fy)<0.5)
+    {
+        b->z+=(abs(b->z-fz)/(b->z-fz))*0.05;
+        b->vz=0;
+    }
+    if(abs(b->vy)>0&&abs(b->y-fy)<1)
+    {
+        if(b->vy)
+        b->y-=b->vy;
+        b->vy=0;
+    }
+    if(abs(flor.vy[i])!=0)
+    { 
+            b->vy=flor.vy[i];
+    }
+    if(abs(flor.vx[i])>0&&abs(b->vx)<0.01)
+            b->vx=flor.vx[i];
+    if(abs(flor.vz[i])>0&&abs(b->vz)<0.01)
+            b->vz=flor.vz[i];
+}
+/* Start tile i crumbling if it is a crumbling tile not yet touched */
+void startCrumbling(int i)
+{
+    if(flor.crumble[i]==0)
+    {
+        flor.crumble[i]=crumble_steps;
+        crumbling.push_back(i);
+    }
+}
+/* After the contacts of collideTiles have all been resolved, start the tiles they touched crumbling */
+void crumbleContacts(int slices)
+{
+    for(int k=0;k<slices;k++)
+    {
+        const vector<contact> &contacts=scratch[k].contacts;
+        for(int c=0;c<contacts.size();c++)
+            startCrumbling(contacts[c].tile);
+    }
+}
+/* Run the tile pipeline for the bodies in list; hit[b] tells whether body b touched any tile.
+   All contacts are found before any are resolved, by slices of bodies on the job pool, and
+   resolved in body order and the order the broadphase produced them. Returns the number
+   of slices, whose contacts stay in scratch for crumbleContacts */
+int collideTiles(object **list,int count,vector<char> &hit)
+{
+    int slices=sliceCount(count,body_grain);
+    if(scratch.size()<slices)
+        scratch.resize(slices);
+    runJobs(slices,[list,count,slices](int k){
+        collisionScratch &s=scratch[k];
+        broadphaseTiles(list,sliceStart(count,slices,k),sliceStart(count,slices,k+1),s.nearby,s.candidates);
+        narrowphaseTiles(list,s.candidates,s.nearby,s.touching,s.contacts);
+    });
+    hit.assign(count,0);
+    for(int k=0;k<slices;k++)
+    {
+        const vector<contact> &contacts=scratch[k].contacts;
+        for(int c=0;c<contacts.size();c++)
+        {
+            resolveTileContact(list[contacts[c].body],contacts[c].tile);
+            hit[contacts[c].body]=1;
+        }
+    }
+    return slices;
+}
+/* Sweep and prune along x: pairs of bodies whose boxes overlap on every axis */
+void broadphaseBodies(object **list,int count,vector<pair<int,int> > &out)
+{
+    out.clear();
+    sweepOrder.resize(count);
+    for(int b=0;b<count;b++)
+        sweepOrder[b]=b;
+    sort(sweepOrder.begin(),sweepOrder.end(),[list](int a,int b){
+        float la=list[a]->x-list[a]->size,lb=list[b]->x-list[b]->size;
+        return la<lb||(la==lb&&a<b);
+    });
+    for(int i=0;i<count;i++)
+    {
+        object *a=list[sweepOrder[i]];
+        for(int j=i+1;j<count;j++)
+        {
+            object *b=list[sweepOrder[j]];
+            if(b->x-b->size>=a->x+a->size)
+                break;      // sorted by left edge, so nothing further along can touch a
+            float reach=a->size+b->size;
+            if(fabsf(a->y-b->y)<reach&&fabsf(a->z-b->z)<reach)
+                out.push_back(make_pair(min(sweepOrder[i],sweepOrder[j]),max(sweepOrder[i],sweepOrder[j])));
+        }
+    }
+    sort(out.begin(),out.end());
+}
+/* Separate two overlapping bodies along the axis they overlap least on, sharing the
+   push by mass, and give them a common velocity along that axis */
+void resolveBodyContact(object *a,object *b)
+{
+    float reach=a->size+b->size;
+    float d[3]={b->x-a->x,b->y-a->y,b->z-a->z};
+    int axis=0;
+    for(int k=1;k<3;k++)
+        if(reach-fabsf(d[k])<reach-fabsf(d[axis]))
+            axis=k;
+    float depth=reach-fabsf(d[axis]);
+    if(depth<=0)
+        return;
+    float ma=a->mass>0?a->mass:1,mb=b->mass>0?b->mass:1;
+    float side=d[axis]<0?-1:1;
+    float *pa[3]={&a->x,&a->y,&a->z},*pb[3]={&b->x,&b->y,&b->z};
+    float *va[3]={&a->vx,&a->vy,&a->vz},*vb[3]={&b->vx,&b->vy,&b->vz};
+    *pa[axis]-=side*depth*mb/(ma+mb);
+    *pb[axis]+=side*depth*ma/(ma+mb);
+    float v=(*va[axis]*ma+*vb[axis]*mb)/(ma+mb);
+    *va[axis]=*vb[axis]=v;
+}
+void collideBodies(object **list,int count)
+{
+    broadphaseBodies(list,count,bodyPairs);
+    for(int k=0;k<bodyPairs.size();k++)
+        resolveBodyContact(list[bodyPairs[k].first],list[bodyPairs[k].second]);
+}
+
+/* Every body stepped by update; the player is always the first */
+vector<object*> bodies;
+vector<char> bodyHit;
+vector<char> landed;
+vector<int> sweepHit;
+
+/* A body moving at least this fast vertically is swept against the tiles instead of
+   stepped, so it can't pass through a tile between two steps. Half a tile's half
+   thickness, well under what tunnels, so falls at terminal speed (0.4) are swept too */
+const float ccd_speed = level_tile_size/2;
+/* Gap left between a swept body and the face it stopped at */
+const float ccd_skin = 1e-4;
+
+/* Time of impact in [0,1] of b's vertical move this step with the first tile in its way,
+   or -1 if nothing is hit. Tiles it already overlaps are left to the discrete test */
+int sweepTiles(object *b,float &toi,vector<int> &nearby)
+{
+    int first=-1;
+    toi=1;
+    queryGrid(b->x,b->z,b->size,nearby);
+    for(int k=0;k<nearby.size();k++)
+    {
+        int i=nearby[k];
+        float reach=flor.size[i]+b->size;
+        if(fabsf(b->x-flor.x[i])>=reach||fabsf(b->z-flor.z[i])>=reach)
+            continue;
+        // distance to the face the body moves towards, negative if it starts past it
+        float gap=b->vy<0?(b->y-b->size)-(flor.y[i]+flor.size[i]):(flor.y[i]-flor.size[i])-(b->y+b->size);
+        if(gap<0||gap>fabsf(b->vy))
+            continue;
+        float t=gap/fabsf(b->vy);
+        if(t<toi||first<0)
+        {
+            toi=t;
+            first=i;
+        }
+    }
+    return first;
+}
+
+bool checkFloor(object *b)
+{
+    crumbleContacts(collideTiles(&b,1,bodyHit));
+    return bodyHit[0];
+}
+/* Fall, collide with the tiles and each other, then move sideways */
+void stepBodies(object **list,int count)
+{
+    landed.assign(count,0);
+    // the sweeps only read the tiles, so they can all run before any body moves
+    sweepHit.resize(count);
+    int slices=sliceCount(count,body_grain);
+    if(scratch.size()<slices)
+        scratch.resize(slices);
+    runJobs(slices,[list,count,slices](int k){
+        for(int j=sliceStart(count,slices,k);j<sliceStart(count,slices,k+1);j++)
+        {
+            float toi;
+            sweepHit[j]=fabsf(list[j]->vy)>=ccd_speed?sweepTiles(list[j],toi,scratch[k].nearby):-1;
+        }
+    });
+    for(int k=0;k<count;k++)
+    {
+        object *b=list[k];
+        int i=sweepHit[k];
+        if(i<0)
+        {
+            b->y+=b->vy;
+            continue;
+        }
+        // stop just short of the face it hit, then respond as to any other contact
+        if(b->vy<0)
+            b->y=flor.y[i]+flor.size[i]+b->size+ccd_skin;
+        else
+            b->y=flor.y[i]-flor.size[i]-b->size-ccd_skin;
+        b->vy=0;
+        resolveTileContact(b,i);
+        landed[k]=1;
+    }
+    slices=collideTiles(list,count,bodyHit);
+    // tiles only change state once every contact of the step is resolved, swept ones first
+    for(int k=0;k<count;k++)
+        if(landed[k])
+            startCrumbling(sweepHit[k]);
+    crumbleContacts(slices);
+    for(int k=0;k<count;k++)
+    {
+        object *b=list[k];
+        if(bodyHit[k]||landed[k])
+            b->y+=b->vy;
+        b->vy*=0.95;
+        b->vy-=0.02;
+        b->x+=b->vx;
+        b->z+=b->vz;
+    }
+    collideBodies(list,count);
+}
+void gravity(object *b)
+{
+    stepBodies(&b,1);
+}
+/* Fill vertices and colors (108 floats each) with the 36 vertices of a cube of half size s */
+void cubeData(float s,int color,GLfloat *vertices,GLfloat *colors)
 {
     GLfloat  vertex_buffer_data[] = {
 
@@ -656,48 +1983,987 @@ VAO* createCube(float s,int color)
         color_buffer_data = color_data;
     }
    
-    
-    return create3DObject(GL_TRIANGLES, 36, vertex_buffer_data, color_buffer_data, GL_FILL);
+    memcpy(vertices, vertex_buffer_data, sizeof(vertex_buffer_data));
+    memcpy(colors, color_buffer_data, sizeof(vertex_buffer_data));
 }
-void createObstacles()
+/* The cube as unique (position, color) corners and 36 indices into them; corners shared
+   by triangles of the same color are merged, so it draws exactly like the 36 vertex cube */
+typedef struct cubeTemplate
 {
-    int obstacles[] = {29,69,46,86,7,13};
-    for(int i=0;i<2;i++){
-        flor[obstacles[i]].y=-1;
-        slideBlock(&flor[obstacles[i]],0);
-    } 
-    
-    for(int i=2;i<4;i++){
-        flor[obstacles[i]].y=-1;
-        slideBlock(&flor[obstacles[i]],1);
+    vector<GLfloat> positions, colors;
+    vector<GLuint> indices;
+}cubeTemplate;
+void indexCube(float s,int color,cubeTemplate &cube)
+{
+    GLfloat vertices[108], colors[108];
+    cubeData(s, color, vertices, colors);
+    cube.positions.clear();
+    cube.colors.clear();
+    cube.indices.clear();
+    for(int v=0;v<36;v++)
+    {
+        int u=0, unique=cube.positions.size()/3;
+        while(u<unique&&(memcmp(&cube.positions[3*u], vertices+3*v, 3*sizeof(GLfloat))
+                         ||memcmp(&cube.colors[3*u], colors+3*v, 3*sizeof(GLfloat))))
+            u++;
+        if(u==unique)
+        {
+            cube.positions.insert(cube.positions.end(), vertices+3*v, vertices+3*v+3);
+            cube.colors.insert(cube.colors.end(), colors+3*v, colors+3*v+3);
+        }
+        cube.indices.push_back(u);
     }
-    for(int i=4;i<6;i++)
+}
+VAO* createCube(float s,int color)
+{
+    cubeTemplate cube;
+    indexCube(s, color, cube);
+    vector<packedVertex> vertices;
+    for(int u=0;u<cube.positions.size()/3;u++)
+        vertices.push_back(packVertex(&cube.positions[3*u], &cube.colors[3*u]));
+    return createIndexedObject(GL_TRIANGLES, vertices, cube.indices, GL_FILL);
+}
+/* All floor tiles share this mesh, so they can be drawn as instances of it */
+instanceBatch floorBatch;
+vector<GLfloat> floorOffsets;
+
+/* Every cube with the same size and color scheme shares one VAO */
+map<pair<float,int>, VAO*> meshCache;
+VAO* cubeMesh(float s,int color)
+{
+    if(headless)
+        return NULL;
+    VAO* &mesh=meshCache[make_pair(s,color)];
+    if(!mesh)
+        mesh=createCube(s,color);
+    return mesh;
+}
+/* Color scheme of the floor tiles */
+const int floor_color = 1;
+
+/* Is there a static tile of half size s centred at (x,y,z)? */
+bool staticTileAt(float x,float y,float z,float s)
+{
+    unordered_map<long long, vector<int> >::const_iterator it=grid.cells.find(gridKey(gridCell(x),gridCell(z)));
+    if(it==grid.cells.end())
+        return false;
+    int moving=flor.bobbing+flor.sliding;
+    for(int k=0;k<it->second.size();k++)
+    {
+        int j=it->second[k];
+        if(j>=moving&&flor.size[j]==s&&fabsf(flor.x[j]-x)<1e-3f&&fabsf(flor.y[j]-y)<1e-3f&&fabsf(flor.z[j]-z)<1e-3f)
+            return true;
+    }
+    return false;
+}
+/* The triangles of the chunk's static tiles relative to origin, leaving out every face
+   pressed against another static tile of the same size. Corners are shared within a tile */
+void bakeTiles(const tileChunk &c,const glm::vec3 &origin,vector<packedVertex> &vertices,vector<GLuint> &indices)
+{
+    vertices.clear();
+    indices.clear();
+    cubeTemplate cube;
+    float cubeSize=-1;
+    vector<int> remap;
+    int moving=flor.bobbing+flor.sliding;
+    for(int r=0;r<c.ranges.size();r++)
+    for(int i=max(c.ranges[r].first,moving);i<c.ranges[r].second;i++)
+    {
+        if(!flor.alive[i])
+            continue;
+        float s=flor.size[i];
+        float p[3]={flor.x[i],flor.y[i],flor.z[i]};
+        if(s!=cubeSize)
+        {
+            indexCube(s, floor_color, cube);
+            cubeSize=s;
+        }
+        remap.assign(cube.positions.size()/3,-1);
+        for(int t=0;t<12;t++)
+        {
+            const GLuint *tri=&cube.indices[3*t];
+            const GLfloat *v0=&cube.positions[3*tri[0]],*v1=&cube.positions[3*tri[1]],*v2=&cube.positions[3*tri[2]];
+            // the face a triangle is on is the axis all three corners share
+            int axis=0;
+            while(axis<2&&!(v0[axis]==v1[axis]&&v0[axis]==v2[axis]))
+                axis++;
+            float n[3]={p[0],p[1],p[2]};
+            n[axis]+=v0[axis]>0?2*s:-2*s;
+            if(staticTileAt(n[0],n[1],n[2],s))
+                continue;
+            for(int k=0;k<3;k++)
+            {
+                int u=tri[k];
+                if(remap[u]<0)
+                {
+                    const GLfloat *v=&cube.positions[3*u];
+                    GLfloat local[3]={v[0]+p[0]-origin.x,v[1]+p[1]-origin.y,v[2]+p[2]-origin.z};
+                    remap[u]=vertices.size();
+                    vertices.push_back(packVertex(local, &cube.colors[3*u]));
+                }
+                indices.push_back(remap[u]);
+            }
+        }
+    }
+}
+vector<packedVertex> bakedVertices;
+vector<GLuint> bakedIndices;
+void bakeChunk(tileChunk &c)
+{
+    delete3DObject(c.baked);
+    c.baked=NULL;
+    c.dirty=false;
+    c.origin=glm::vec3(c.cx*chunk_size,floorf(0.5f*(c.lo.y+c.hi.y)),c.cz*chunk_size);
+    bakeTiles(c, c.origin, bakedVertices, bakedIndices);
+    if(!bakedIndices.empty())
+        c.baked=createIndexedObject(GL_TRIANGLES, bakedVertices, bakedIndices, GL_FILL);
+}
+/* Bake the visible chunks whose static tiles changed, the bake_budget nearest to centre
+   unless every frame has to be exact */
+vector<pair<float,int> > bakeQueue;
+void bakeVisibleChunks(const glm::vec3 &centre)
+{
+    bakeQueue.clear();
+    for(int k=0;k<visibleChunks.size();k++)
+    {
+        const tileChunk &c=chunks[visibleChunks[k]];
+        if(c.dirty)
+            bakeQueue.push_back(make_pair(glm::length(0.5f*(c.lo+c.hi)-centre),visibleChunks[k]));
+    }
+    if(!exact_frames&&bakeQueue.size()>bake_budget)
     {
-        flor[obstacles[i]].y=-1;
-        slideBlock(&flor[obstacles[i]],3);
+        partial_sort(bakeQueue.begin(), bakeQueue.begin()+bake_budget, bakeQueue.end());
+        bakeQueue.resize(bake_budget);
     }
+    for(int k=0;k<bakeQueue.size();k++)
+        bakeChunk(chunks[bakeQueue[k].second]);
+}
+/* Add a slot at the end for a static tile at (x,y,z), outside any chunk and the grid */
+int appendSlot(float x,float y,float z,float size)
+{
+    flor.posx.push_back(x); flor.posy.push_back(y); flor.posz.push_back(z);
+    flor.x.push_back(x); flor.y.push_back(y); flor.z.push_back(z);
+    flor.lastx.push_back(x); flor.lasty.push_back(y); flor.lastz.push_back(z);
+    flor.vx.push_back(0); flor.vy.push_back(0); flor.vz.push_back(0);
+    flor.size.push_back(size);
+    flor.lox.push_back(-FLT_MAX); flor.hix.push_back(FLT_MAX);
+    flor.loy.push_back(-FLT_MAX); flor.hiy.push_back(FLT_MAX);
+    flor.loz.push_back(-FLT_MAX); flor.hiz.push_back(FLT_MAX);
+    flor.kind.push_back(STATIC_TILE);
+    flor.cellx.push_back(0); flor.cellz.push_back(0);
+    flor.alive.push_back(1);
+    flor.chunk.push_back(-1);
+    flor.crumble.push_back(-1);
+    flor.source.push_back(-1);
+    return flor.n++;
+}
+/* Add a static tile at (x,y,z) and return its handle, reusing a removed tile's slot if there is one.
+   It goes into the grid and the chunk it is in, whose baked mesh is redone */
+int addTile(float x,float y,float z,float size)
+{
+    int i;
+    if(!flor.freeSlots.empty())
+    {
+        i=flor.freeSlots.back();
+        flor.freeSlots.pop_back();
+        flor.posx[i]=flor.x[i]=flor.lastx[i]=x;
+        flor.posy[i]=flor.y[i]=flor.lasty[i]=y;
+        flor.posz[i]=flor.z[i]=flor.lastz[i]=z;
+        flor.size[i]=size;
+        flor.kind[i]=STATIC_TILE;
+        flor.crumble[i]=-1;
+        flor.alive[i]=1;
+    }
+    else
+        i=appendSlot(x,y,z,size);
+    gridInsert(i);
+    assignChunk(i);
+    markTileDirty(x,z);
+    return i;
+}
+/* Remove a tile in constant time. Its slot stays where it is, so every other
+   handle stays valid; it just stops moving, leaves the grid and is not drawn */
+void removeTile(int i)
+{
+    if(!flor.alive[i])
+        return;
+    gridRemove(i);
+    markTileDirty(flor.x[i],flor.z[i]);
+    flor.alive[i]=0;
+    flor.vx[i]=flor.vy[i]=flor.vz[i]=0;
+    flor.lox[i]=flor.loy[i]=flor.loz[i]=-FLT_MAX;
+    flor.hix[i]=flor.hiy[i]=flor.hiz[i]=FLT_MAX;
+    flor.kind[i]=STATIC_TILE;
+    flor.crumble[i]=-1;
+    // a streamed slot goes back with the rest of its chunk when that is evicted, and a
+    // moving tile's slot stays dead: addTile only makes static tiles, which come after them
+    if(flor.source[i]<0&&i>=flor.bobbing+flor.sliding)
+        flor.freeSlots.push_back(i);
+}
+template <typename T> void permute(vector<T> &v,const vector<int> &order)
+{
+    vector<T> sorted(order.size());
+    for(int i=0;i<order.size();i++)
+        sorted[i]=v[order[i]];
+    v.swap(sorted);
+}
+/* Reorder the tiles so bobbing ones come first, then sliding ones, then the rest,
+   each group sorted by chunk.
+   Removed slots are dropped, so this changes handles: only use it while building a level */
+void groupMovingTiles()
+{
+    vector<int> order;
+    for(int i=0;i<flor.n;i++)
+        if(flor.alive[i])
+            order.push_back(i);
+    stable_sort(order.begin(), order.end(), [](int a,int b){
+        if(flor.kind[a]!=flor.kind[b])
+            return flor.kind[a]<flor.kind[b];
+        int ax=chunkOf(flor.posx[a]),bx=chunkOf(flor.posx[b]);
+        if(ax!=bx)
+            return ax<bx;
+        return chunkOf(flor.posz[a])<chunkOf(flor.posz[b]);
+    });
+    permute(flor.posx,order); permute(flor.posy,order); permute(flor.posz,order);
+    permute(flor.x,order); permute(flor.y,order); permute(flor.z,order);
+    permute(flor.lastx,order); permute(flor.lasty,order); permute(flor.lastz,order);
+    permute(flor.vx,order); permute(flor.vy,order); permute(flor.vz,order);
+    permute(flor.size,order);
+    permute(flor.lox,order); permute(flor.hix,order);
+    permute(flor.loy,order); permute(flor.hiy,order);
+    permute(flor.loz,order); permute(flor.hiz,order);
+    permute(flor.kind,order);
+    permute(flor.cellx,order); permute(flor.cellz,order);
+    permute(flor.alive,order); permute(flor.crumble,order);
+    permute(flor.source,order);
+    flor.n=order.size();
+    flor.freeSlots.clear();
+    flor.bobbing=count(flor.kind.begin(), flor.kind.end(), (int)BOBBING_TILE);
+    flor.sliding=count(flor.kind.begin(), flor.kind.end(), (int)SLIDING_TILE);
+    buildGrid();
+    buildChunks();
+}
+/* Compiled level file (.lvb): this header, chunks entries of the chunk directory, then
+   count tiles already in tileStore order (bobbing, then sliding, then static, each by chunk) */
+const int level_version = 3;
+typedef struct levelFileHeader
+{
+        char magic[4];
+        int version;
+        int count;
+        int chunks;
+        levelInfo info;
+}levelFileHeader;
+/* One chunk with tiles in it; first/count are its static tiles, lo/hi bound them */
+typedef struct levelFileChunk
+{
+        int cx,cz;
+        int first,count;
+        float lo[3],hi[3];
+}levelFileChunk;
+typedef struct levelFileTile
+{
+        float x,y,z;
+        int type;           // the character used for the tile in the text file
+}levelFileTile;
 
+int tileGroup(int type)
+{
+    if(type=='b')
+        return BOBBING_TILE;
+    if(type=='.'||type=='c')
+        return STATIC_TILE;
+    return SLIDING_TILE;
 }
-void createFloor()
+
+/* Parse a text level (see level1.lvl) and write its compiled form to bin_path */
+void compileLevel(const char *text_path,const char *bin_path)
 {
-    for(int i=-5;i<5;i++)
-            for(int j=-5;j<5;j++)
+    std::ifstream in(text_path, std::ios::in);
+    if(!in.is_open()){
+        fprintf(stderr, "Cannot open level %s\n", text_path);
+        exit(EXIT_FAILURE);
+    }
+    levelFileHeader header;
+    memcpy(header.magic, "LVB1", 4);
+    header.version=level_version;
+    float originx=0, originz=0, floory=-2;
+    int rows=0, cols=0;
+    vector<levelFileTile> tiles;
+    string line;
+    int line_no=0;
+    while(getline(in, line))
+    {
+        line_no++;
+        if(!line.empty()&&line[line.size()-1]=='\r')
+            line.erase(line.size()-1);
+        if(line.empty()||line[0]=='#')
+            continue;
+        if(!line.compare(0, 7, "origin ")){
+            if(sscanf(line.c_str()+7, "%f %f", &originx, &originz)!=2)
+                goto bad_line;
+            continue;
+        }
+        if(!line.compare(0, 6, "floor ")){
+            if(sscanf(line.c_str()+6, "%f", &floory)!=1)
+                goto bad_line;
+            continue;
+        }
+        for(int j=0;j<line.size();j++)
+        {
+            if(line[j]=='_')
+                continue;
+            if(!strchr(".cbZzXx", line[j]))
+                goto bad_line;
+            levelFileTile tile;
+            tile.x=originx+rows;
+            tile.z=originz+j;
+            tile.y=strchr(".cb", line[j])?floory:floory+1;  // sliders are raised above the floor
+            tile.type=line[j];
+            tiles.push_back(tile);
+        }
+        cols=max(cols,(int)line.size());
+        rows++;
+        continue;
+bad_line:
+        fprintf(stderr, "%s:%d: bad level line '%s'\n", text_path, line_no, line.c_str());
+        exit(EXIT_FAILURE);
+    }
+    stable_sort(tiles.begin(), tiles.end(), [](const levelFileTile &a,const levelFileTile &b){
+        if(tileGroup(a.type)!=tileGroup(b.type))
+            return tileGroup(a.type)<tileGroup(b.type);
+        if(chunkOf(a.x)!=chunkOf(b.x))
+            return chunkOf(a.x)<chunkOf(b.x);
+        return chunkOf(a.z)<chunkOf(b.z);
+    });
+    // one directory entry per chunk holding any tile, moving or not
+    vector<levelFileChunk> dir;
+    map<pair<int,int>,int> dirIndex;
+    for(int i=0;i<tiles.size();i++)
+    {
+        pair<int,int> key(chunkOf(tiles[i].x),chunkOf(tiles[i].z));
+        map<pair<int,int>,int>::iterator it=dirIndex.find(key);
+        if(it==dirIndex.end())
+        {
+            levelFileChunk c;
+            c.cx=key.first;
+            c.cz=key.second;
+            c.first=c.count=0;
+            for(int k=0;k<3;k++)
+                c.lo[k]=FLT_MAX,c.hi[k]=-FLT_MAX;
+            it=dirIndex.insert(make_pair(key,(int)dir.size())).first;
+            dir.push_back(c);
+        }
+        if(tileGroup(tiles[i].type)!=STATIC_TILE)
+            continue;
+        levelFileChunk &c=dir[it->second];
+        if(!c.count)
+            c.first=i;
+        c.count++;
+        float p[3]={tiles[i].x,tiles[i].y,tiles[i].z};
+        for(int k=0;k<3;k++)
+        {
+            c.lo[k]=min(c.lo[k],p[k]-level_tile_size);
+            c.hi[k]=max(c.hi[k],p[k]+level_tile_size);
+        }
+    }
+    header.count=tiles.size();
+    header.chunks=dir.size();
+    header.info.minx=originx;
+    header.info.maxx=originx+rows;
+    header.info.minz=originz;
+    header.info.maxz=originz+cols;
+    header.info.floory=floory;
+
+    // write next to the final name and rename, so a half written file is never picked up
+    string tmp_path=string(bin_path)+".tmp";
+    FILE *out=fopen(tmp_path.c_str(), "wb");
+    if(!out||fwrite(&header, sizeof(header), 1, out)!=1
+       ||fwrite(dir.data(), sizeof(levelFileChunk), dir.size(), out)!=dir.size()
+       ||fwrite(tiles.data(), sizeof(levelFileTile), tiles.size(), out)!=tiles.size()
+       ||fclose(out)!=0||rename(tmp_path.c_str(), bin_path)!=0){
+        fprintf(stderr, "Cannot write compiled level %s\n", bin_path);
+        exit(EXIT_FAILURE);
+    }
+}
+
+/* Memory map a compiled level, returning NULL if it is missing or not one we understand */
+const levelFileHeader* mapLevel(const char *bin_path,size_t *length)
+{
+    int fd=open(bin_path, O_RDONLY);
+    if(fd<0)
+        return NULL;
+    struct stat st;
+    void *data=MAP_FAILED;
+    if(fstat(fd, &st)==0&&st.st_size>=sizeof(levelFileHeader))
+        data=mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+    close(fd);
+    if(data==MAP_FAILED)
+        return NULL;
+    const levelFileHeader *header=(const levelFileHeader*)data;
+    bool valid=!memcmp(header->magic, "LVB1", 4)&&header->version==level_version&&header->count>=0&&header->chunks>=0
+       &&st.st_size==sizeof(levelFileHeader)+header->chunks*sizeof(levelFileChunk)+header->count*sizeof(levelFileTile);
+    const levelFileChunk *dir=(const levelFileChunk*)(header+1);
+    for(int c=0;valid&&c<header->chunks;c++)
+        valid=dir[c].first>=0&&dir[c].count>=0&&dir[c].first+dir[c].count<=header->count;
+    if(!valid){
+        munmap(data, st.st_size);
+        return NULL;
+    }
+    *length=st.st_size;
+    return header;
+}
+
+/* Static tiles are streamed in by chunk. A loader thread reads and decodes the chunks
+   within prefetch_radius of a body, nearest first, and each step puts in a few of the
+   ones it has ready, so the frame loop does not wait on the file. Only the chunks around
+   a body's own are put in as soon as it gets there, read here if the loader is behind,
+   so what a body can touch never depends on how fast the loader was. A chunk stays
+   resident until more than stream_budget are and it is the one needed least recently.
+   Moving tiles are few and roam across chunks, so they are always loaded */
+/* A body can cross a whole chunk, corner to corner, before residency is decided again,
+   so every chunk within draw_distance of it has to be loaded by then */
+const float chunk_diagonal = chunk_size*sqrtf(2);
+float load_radius = draw_distance+chunk_diagonal;
+float prefetch_radius = load_radius+2*chunk_size;
+int stream_budget = 256;
+int install_budget = 4;     // chunks the loader thread has ready put in per step
+
+/* A static tile as the loader thread decodes it */
+typedef struct loadedTile
+{
+    float x,y,z;
+    int crumble;
+}loadedTile;
+
+typedef struct worldStream
+{
+    bool active;
+    const levelFileHeader *header;      // the compiled level stays mapped while streaming
+    size_t length;
+    const levelFileChunk *dir;          // indexed like chunks
+    const levelFileTile *tiles;
+    int x0,z0,columns,rows;             // chunk (x0+a,z0+b) is at[a*rows+b], -1 if it has no entry
+    vector<int> at;
+    vector<int> block;                  // first slot of a resident chunk's static tiles, -1 if not resident
+    vector<long long> lastUsed;         // last step a body was within load_radius
+    std::list<int> lru;                 // resident chunks, the one needed least recently first
+    vector<std::list<int>::iterator> lruAt;
+    vector<vector<unsigned char> > gone;// per tile, 1 if removed while resident; empty if none was
+    vector<vector<glm::vec4> > added;   // static tiles added at run time (x,y,z,size), put back when reloaded
+    vector<int> pending;                // within load_radius and waiting for the loader thread, nearest first
+    vector<int> seen;                   // the decision that last looked at a chunk
+    vector<pair<int,int> > freeBlocks;  // (first,count) runs of slots given back by evicted chunks
+    vector<pair<int,int> > bodyChunks;  // where the bodies were when residency was last decided
+    long long decided;                  // the step it was decided on
+    int decisions;
+    int resident;
+    int loads, misses, evictions;       // misses had to be read on the main thread
+
+    // shared with the loader thread, under lock
+    std::thread worker;
+    std::mutex lock;
+    std::condition_variable wake;
+    vector<int> wanted;                 // chunks to read, nearest last
+    map<int, vector<loadedTile> > ready;
+    bool stop;
+}worldStream;
+worldStream stream;
+
+/* Copy chunk c's tiles out of the mapping, which is what faults them in from disk, decoded */
+void readChunk(int c,vector<loadedTile> &out)
+{
+    const levelFileTile *t=stream.tiles+stream.dir[c].first;
+    out.resize(stream.dir[c].count);
+    for(int k=0;k<out.size();k++)
+    {
+        out[k].x=t[k].x;
+        out[k].y=t[k].y;
+        out[k].z=t[k].z;
+        out[k].crumble=t[k].type=='c'?0:-1;
+    }
+}
+
+void streamWorker()
+{
+    std::unique_lock<std::mutex> hold(stream.lock);
+    while(true)
+    {
+        stream.wake.wait(hold, [](){ return stream.stop||!stream.wanted.empty(); });
+        if(stream.stop)
+            return;
+        int c=stream.wanted.back();
+        stream.wanted.pop_back();
+        hold.unlock();
+        vector<loadedTile> data;
+        readChunk(c,data);
+        hold.lock();
+        stream.ready[c].swap(data);
+    }
+}
+
+void stopStreaming()
+{
+    if(!stream.active)
+        return;
+    {
+        std::lock_guard<std::mutex> hold(stream.lock);
+        stream.stop=true;
+    }
+    stream.wake.notify_one();
+    stream.worker.join();
+    munmap((void*)stream.header, stream.length);
+    stream.active=false;
+    stream.wanted.clear();
+    stream.ready.clear();
+    stream.pending.clear();
+    stream.lru.clear();
+}
+
+/* Start streaming from a mapped level whose moving tiles are already in flor: set up
+   one chunk per directory entry and put the moving tiles in theirs */
+void startStreaming(const levelFileHeader *header,size_t length)
+{
+    static bool registered=false;
+    if(!registered)
+        atexit(stopStreaming);  // the loader thread has to be joined before exit
+    registered=true;
+
+    stream.header=header;
+    stream.length=length;
+    stream.dir=(const levelFileChunk*)(header+1);
+    stream.tiles=(const levelFileTile*)(stream.dir+header->chunks);
+    stream.block.assign(header->chunks,-1);
+    stream.lastUsed.assign(header->chunks,-1);
+    stream.lru.clear();
+    stream.lruAt.assign(header->chunks,stream.lru.end());
+    stream.gone.assign(header->chunks,vector<unsigned char>());
+    stream.added.assign(header->chunks,vector<glm::vec4>());
+    stream.pending.clear();
+    stream.seen.assign(header->chunks,0);
+    stream.freeBlocks.clear();
+    stream.bodyChunks.clear();
+    stream.decided=-1;
+    stream.decisions=0;
+    stream.resident=stream.loads=stream.misses=stream.evictions=0;
+
+    // the directory as a dense grid, so a body's window of chunks is found without a search
+    int x1=0,z1=-1;
+    stream.x0=stream.z0=0;
+    for(int c=0;c<header->chunks;c++)
+    {
+        if(!c||stream.dir[c].cx<stream.x0) stream.x0=stream.dir[c].cx;
+        if(!c||stream.dir[c].cz<stream.z0) stream.z0=stream.dir[c].cz;
+        if(!c||stream.dir[c].cx>x1) x1=stream.dir[c].cx;
+        if(!c||stream.dir[c].cz>z1) z1=stream.dir[c].cz;
+    }
+    stream.columns=header->chunks?x1-stream.x0+1:0;
+    stream.rows=header->chunks?z1-stream.z0+1:0;
+    stream.at.assign(stream.columns*stream.rows,-1);
+
+    clearChunks();
+    for(int c=0;c<header->chunks;c++)
+    {
+        tileChunk chunk;
+        chunk.cx=stream.dir[c].cx;
+        chunk.cz=stream.dir[c].cz;
+        chunk.lo=glm::vec3(stream.dir[c].lo[0],stream.dir[c].lo[1],stream.dir[c].lo[2]);
+        chunk.hi=glm::vec3(stream.dir[c].hi[0],stream.dir[c].hi[1],stream.dir[c].hi[2]);
+        chunk.baked=NULL;
+        chunk.dirty=true;
+        chunks.push_back(chunk);
+        chunkIndex[gridKey(chunk.cx,chunk.cz)]=c;
+        stream.at[(chunk.cx-stream.x0)*stream.rows+chunk.cz-stream.z0]=c;
+    }
+    flor.chunk.assign(flor.n,-1);
+    for(int i=0;i<flor.n;i++)
+    {
+        unordered_map<long long,int>::iterator it=chunkIndex.find(gridKey(chunkOf(flor.posx[i]),chunkOf(flor.posz[i])));
+        if(it==chunkIndex.end())
+            continue;
+        tileChunk &c=chunks[it->second];
+        if(!c.ranges.empty()&&c.ranges.back().second==i)
+            c.ranges.back().second++;
+        else
+            c.ranges.push_back(make_pair(i,i+1));
+        flor.chunk[i]=it->second;
+        extendChunk(c,i);
+    }
+
+    stream.stop=false;
+    stream.active=true;
+    stream.worker=std::thread(streamWorker);
+}
+
+/* count free slots in a row for a chunk, from an evicted chunk's run if one is big enough */
+int allocateBlock(int count)
+{
+    for(int k=0;k<stream.freeBlocks.size();k++)
+    {
+        pair<int,int> &b=stream.freeBlocks[k];
+        if(b.second<count)
+            continue;
+        int first=b.first;
+        b.first+=count;
+        b.second-=count;
+        if(!b.second)
+            stream.freeBlocks.erase(stream.freeBlocks.begin()+k);
+        return first;
+    }
+    // the run has to be contiguous, so it never takes slots freed by removeTile
+    int first=flor.n;
+    for(int k=0;k<count;k++)
+    {
+        appendSlot(0,0,0,level_tile_size);
+        flor.alive[first+k]=0;
+    }
+    return first;
+}
+void freeBlock(int first,int count)
+{
+    stream.freeBlocks.push_back(make_pair(first,count));
+    sort(stream.freeBlocks.begin(), stream.freeBlocks.end());
+    int merged=0;
+    for(int k=0;k<stream.freeBlocks.size();k++)
+    {
+        if(merged>0&&stream.freeBlocks[merged-1].first+stream.freeBlocks[merged-1].second==stream.freeBlocks[k].first)
+            stream.freeBlocks[merged-1].second+=stream.freeBlocks[k].second;
+        else
+            stream.freeBlocks[merged++]=stream.freeBlocks[k];
+    }
+    stream.freeBlocks.resize(merged);
+}
+
+/* Put chunk c's decoded static tiles into flor, leaving out the ones removed before */
+void installChunk(int c,const vector<loadedTile> &data)
+{
+    const levelFileChunk &d=stream.dir[c];
+    int first=allocateBlock(d.count);
+    const vector<unsigned char> &gone=stream.gone[c];
+    for(int k=0;k<d.count;k++)
+    {
+        int i=first+k;
+        const loadedTile &t=data[k];
+        flor.posx[i]=flor.x[i]=flor.lastx[i]=t.x;
+        flor.posy[i]=flor.y[i]=flor.lasty[i]=t.y;
+        flor.posz[i]=flor.z[i]=flor.lastz[i]=t.z;
+        flor.vx[i]=flor.vy[i]=flor.vz[i]=0;
+        flor.size[i]=level_tile_size;
+        flor.lox[i]=flor.loy[i]=flor.loz[i]=-FLT_MAX;
+        flor.hix[i]=flor.hiy[i]=flor.hiz[i]=FLT_MAX;
+        flor.kind[i]=STATIC_TILE;
+        flor.chunk[i]=c;
+        flor.crumble[i]=t.crumble;
+        if(!gone.empty()&&gone[k])
+        {
+            flor.alive[i]=0;
+            flor.source[i]=-1;
+            continue;
+        }
+        flor.alive[i]=1;
+        flor.source[i]=d.first+k;
+        gridInsert(i);
+    }
+    if(d.count)
+        chunks[c].ranges.push_back(make_pair(first,first+d.count));
+    vector<glm::vec4> &added=stream.added[c];
+    for(int k=0;k<added.size();k++)
+        addTile(added[k].x,added[k].y,added[k].z,added[k].w);
+    added.clear();
+    stream.block[c]=first;
+    stream.lruAt[c]=stream.lru.insert(stream.lru.end(),c);
+    stream.resident++;
+    stream.loads++;
+    markChunkDirty(d.cx,d.cz);
+    markChunkDirty(d.cx-1,d.cz); markChunkDirty(d.cx+1,d.cz);
+    markChunkDirty(d.cx,d.cz-1); markChunkDirty(d.cx,d.cz+1);
+}
+/* Put chunk c in now, taking it from the loader thread if it has it and reading it here if not */
+void makeResident(int c)
+{
+    vector<loadedTile> data;
+    bool have=false;
+    {
+        std::lock_guard<std::mutex> hold(stream.lock);
+        map<int, vector<loadedTile> >::iterator it=stream.ready.find(c);
+        if(it!=stream.ready.end())
+        {
+            data.swap(it->second);
+            stream.ready.erase(it);
+            have=true;
+        }
+    }
+    if(!have)
+    {
+        readChunk(c,data);
+        stream.misses++;
+    }
+    installChunk(c,data);
+}
+
+/* Take chunk c's static tiles out of flor, remembering which ones were removed */
+void evictChunk(int c)
+{
+    const levelFileChunk &d=stream.dir[c];
+    int first=stream.block[c];
+    vector<unsigned char> &gone=stream.gone[c];
+    for(int i=first;i<first+d.count;i++)
+    {
+        // a tile that was counting down is gone too: it would have fallen long before
+        // a body could be back, and when that is depends on the loader thread
+        bool fell=flor.alive[i]?flor.crumble[i]>0:flor.source[i]>=0;
+        if(flor.alive[i])
+            gridRemove(i);
+        if(fell)
+        {
+            if(gone.empty())
+                gone.assign(d.count,0);
+            gone[i-first]=1;
+        }
+        flor.alive[i]=0;
+        flor.source[i]=-1;
+        flor.crumble[i]=-1;
+    }
+    for(int k=0;k<crumbling.size();)
+        if(crumbling[k]>=first&&crumbling[k]<first+d.count)
+        {
+            crumbling[k]=crumbling.back();
+            crumbling.pop_back();
+        }
+        else
+            k++;
+    // static tiles added at run time leave with the chunk and come back with it;
+    // only the moving tiles that started in it stay
+    int moving=flor.bobbing+flor.sliding;
+    vector<pair<int,int> > &ranges=chunks[c].ranges, kept;
+    for(int k=0;k<ranges.size();k++)
+    {
+        for(int i=max(ranges[k].first,moving);i<ranges[k].second;i++)
+        {
+            if(i>=first&&i<first+d.count)
+                continue;
+            if(flor.alive[i])
             {
-                object box;
-                box.posz=j;
-                box.posx=i;
-                box.posy=-2;
-                box.x=i;
-                box.y=-2;
-                box.z=j;
-                box.size=0.5;
-                box.vx=0;
-                box.vy=0;
-                box.vz=0;
-                box.sprite=createCube(0.5,1);
-                flor.push_back(box);
+                stream.added[c].push_back(glm::vec4(flor.x[i],flor.y[i],flor.z[i],flor.size[i]));
+                gridRemove(i);
+                flor.alive[i]=0;
+                flor.freeSlots.push_back(i);
             }
-    deleteTiles();
+            flor.chunk[i]=-1;
+        }
+        if(ranges[k].first<moving)
+            kept.push_back(make_pair(ranges[k].first,min(ranges[k].second,moving)));
+    }
+    ranges.swap(kept);
+    if(d.count)
+        freeBlock(first,d.count);
+    stream.block[c]=-1;
+    stream.lru.erase(stream.lruAt[c]);
+    stream.resident--;
+    stream.evictions++;
+    markChunkDirty(d.cx,d.cz);
+    markChunkDirty(d.cx-1,d.cz); markChunkDirty(d.cx+1,d.cz);
+    markChunkDirty(d.cx,d.cz-1); markChunkDirty(d.cx,d.cz+1);
+}
+/* Over budget: evict the chunks needed least recently, never one needed at the last decision */
+void evictOverBudget()
+{
+    while(stream.resident>stream_budget&&stream.lastUsed[stream.lru.front()]<stream.decided)
+        evictChunk(stream.lru.front());
+}
+
+/* Distance in the floor plane from any body to the cells of chunk (cx,cz), 0 if one is over it */
+float chunkDistance(int cx,int cz)
+{
+    float lox=cx*chunk_size-0.5f,loz=cz*chunk_size-0.5f;
+    float best=FLT_MAX;
+    for(int k=0;k<bodies.size();k++)
+    {
+        float dx=max(max(lox-bodies[k]->x,bodies[k]->x-lox-chunk_size),0.0f);
+        float dz=max(max(loz-bodies[k]->z,bodies[k]->z-loz-chunk_size),0.0f);
+        best=min(best,dx*dx+dz*dz);
+    }
+    return sqrt(best);
+}
+/* Can a body touch a tile of chunk (cx,cz) before residency is decided again? */
+bool nextToBody(int cx,int cz)
+{
+    for(int k=0;k<stream.bodyChunks.size();k++)
+        if(abs(cx-stream.bodyChunks[k].first)<=1&&abs(cz-stream.bodyChunks[k].second)<=1)
+            return true;
+    return false;
+}
+
+/* Go through the chunks in the window around each body: the ones within load_radius are
+   needed, and put in now if a body is next to them and queued for the loader thread if
+   not. Then evict what is over budget and hand the loader the queue, followed by the
+   chunks a little further out */
+void decideResidency()
+{
+    stream.decided=sim_tick;
+    stream.decisions++;
+    vector<pair<float,int> > pending, prefetch;
+    for(int b=0;b<bodies.size();b++)
+    {
+        int cx0=max(chunkOf(bodies[b]->x-prefetch_radius),stream.x0);
+        int cx1=min(chunkOf(bodies[b]->x+prefetch_radius),stream.x0+stream.columns-1);
+        int cz0=max(chunkOf(bodies[b]->z-prefetch_radius),stream.z0);
+        int cz1=min(chunkOf(bodies[b]->z+prefetch_radius),stream.z0+stream.rows-1);
+        for(int cx=cx0;cx<=cx1;cx++)
+        for(int cz=cz0;cz<=cz1;cz++)
+        {
+            int c=stream.at[(cx-stream.x0)*stream.rows+cz-stream.z0];
+            if(c<0||stream.seen[c]==stream.decisions)
+                continue;
+            stream.seen[c]=stream.decisions;
+            if(!stream.dir[c].count&&stream.added[c].empty()&&stream.block[c]<0)
+                continue;
+            float d=chunkDistance(cx,cz);
+            if(d<=load_radius)
+            {
+                stream.lastUsed[c]=sim_tick;
+                if(stream.block[c]>=0)
+                    stream.lru.splice(stream.lru.end(),stream.lru,stream.lruAt[c]);
+                else if(exact_frames||nextToBody(cx,cz))
+                    makeResident(c);
+                else
+                    pending.push_back(make_pair(d,c));
+            }
+            else if(d<=prefetch_radius&&stream.block[c]<0)
+                prefetch.push_back(make_pair(d,c));
+        }
+    }
+    sort(pending.begin(), pending.end());
+    sort(prefetch.begin(), prefetch.end());
+    stream.pending.clear();
+    for(int k=0;k<pending.size();k++)
+        stream.pending.push_back(pending[k].second);
+    evictOverBudget();
+
+    // a fresh list for the loader thread, nearest last, dropping what it read that is no longer wanted
+    {
+        std::lock_guard<std::mutex> hold(stream.lock);
+        map<int, vector<loadedTile> > keep;
+        stream.wanted.clear();
+        for(int k=pending.size()+prefetch.size()-1;k>=0;k--)
+        {
+            int c=k<pending.size()?pending[k].second:prefetch[k-pending.size()].second;
+            map<int, vector<loadedTile> >::iterator it=stream.ready.find(c);
+            if(it==stream.ready.end())
+                stream.wanted.push_back(c);
+            else
+                keep[c].swap(it->second);
+        }
+        stream.ready.swap(keep);
+    }
+    stream.wake.notify_one();
+}
+
+/* Put in up to install_budget of the queued chunks the loader thread has ready, nearest first */
+void installReady()
+{
+    static vector<int> taken;
+    static vector<vector<loadedTile> > data;
+    taken.clear();
+    {
+        std::lock_guard<std::mutex> hold(stream.lock);
+        for(int k=0;k<stream.pending.size()&&taken.size()<install_budget;k++)
+        {
+            map<int, vector<loadedTile> >::iterator it=stream.ready.find(stream.pending[k]);
+            if(it==stream.ready.end())
+                continue;
+            if(data.size()<=taken.size())
+                data.resize(taken.size()+1);
+            data[taken.size()].swap(it->second);
+            taken.push_back(it->first);
+            stream.ready.erase(it);
+        }
+    }
+    for(int k=0;k<taken.size();k++)
+    {
+        installChunk(taken[k],data[k]);
+        stream.pending.erase(find(stream.pending.begin(),stream.pending.end(),taken[k]));
+    }
+    evictOverBudget();
+}
+
+/* Decide which chunks are needed when a body has moved into another chunk, and put in
+   the ones the loader thread has read since */
+void streamWorld()
+{
+    if(!stream.active)
+        return;
+    vector<pair<int,int> > now(bodies.size());
+    for(int k=0;k<bodies.size();k++)
+        now[k]=make_pair(chunkOf(bodies[k]->x),chunkOf(bodies[k]->z));
+    if(now!=stream.bodyChunks)
+    {
+        stream.bodyChunks.swap(now);
+        decideResidency();
+    }
+    if(!stream.pending.empty())
+        installReady();
+}
+/* Load a level into flor. The compiled file next to it (level1.lvl -> level1.lvb) is used
+   when it is newer than the text, otherwise it is rebuilt first */
+void loadLevel(const char *text_path)
+{
+    stopStreaming();
+    string bin_path=text_path;
+    size_t dot=bin_path.rfind('.');
+    if(dot!=string::npos&&bin_path.find('/',dot)==string::npos)
+        bin_path.erase(dot);
+    bin_path+=".lvb";
+
+    struct stat text_st, bin_st;
+    bool have_text=stat(text_path, &text_st)==0;
+    bool stale=stat(bin_path.c_str(), &bin_st)!=0||(have_text&&bin_st.st_mtime<text_st.st_mtime);
+    if(stale)
+        compileLevel(text_path, bin_path.c_str());
+
+    size_t length;
+    const levelFileHeader *header=mapLevel(bin_path.c_str(), &length);
+    if(!header&&!stale){
+        // left behind by an older build, compile it again
+        compileLevel(text_path, bin_path.c_str());
+        header=mapLevel(bin_path.c_str(), &length);
+    }
+    if(!header){
+        fprintf(stderr, "Cannot load compiled level %s\n", bin_path.c_str());
+        exit(EXIT_FAILURE);
+    }
+
+    level=header->info;
+    Floor_limit=level.floory;
+    const levelFileChunk *dir=(const levelFileChunk*)(header+1);
+    const levelFileTile *tiles=(const levelFileTile*)(dir+header->chunks);
+    flor=tileStore();
+    crumbling.clear();
+    // only the moving tiles are loaded here, the static ones after them are streamed in by chunk
+    for(int i=0;i<header->count&&tileGroup(tiles[i].type)!=STATIC_TILE;i++)
+    {
+        int t=addTile(tiles[i].x,tiles[i].y,tiles[i].z,level_tile_size);
+        switch(tiles[i].type)
+        {
+            case 'b': moveTile(t); break;
+            case 'Z': slideBlock(t,0); break;
+            case 'z': slideBlock(t,1); break;
+            case 'x': slideBlock(t,2); break;
+            case 'X': slideBlock(t,3); break;
+        }
+    }
+
+    // the compiled file is already grouped, so only the counts are needed
+    flor.bobbing=count(flor.kind.begin(), flor.kind.end(), (int)BOBBING_TILE);
+    flor.sliding=count(flor.kind.begin(), flor.kind.end(), (int)SLIDING_TILE);
+    buildGrid();
+    startStreaming(header, length);
+}
+
+void createFloor()
+{
+    loadLevel(level_path);
+    flor.sprite=cubeMesh(0.5,floor_color);
     player.vy=0;
     player.vz=0;
     player.vx=0;
@@ -706,100 +2972,231 @@ void createFloor()
     player.z=0;
     player.size=0.2;
     player.on_platform=false;
-    player.sprite=createCube(0.2,0);
+    savePosition(&player);
+    player.mass=1;
+    player.sprite=cubeMesh(0.2,0);
+    bodies.clear();
+    bodies.push_back(&player);
+    streamWorld();
 }
 
 float camera_rotation_angle = 90;
 float rectangle_rotation = 0;
 float triangle_rotation = 0;
 
-void deleteTiles()
+/* The simulation always advances in steps of this many seconds, whatever the frame rate */
+const double timestep = 1.0/60.0;
+/* Longest frame we try to catch up on, so a stall doesn't snowball into more and more steps */
+const double max_frame_time = 0.25;
+
+/* Make tile i move along one axis, turning around outside [lo,hi];
+   call groupMovingTiles afterwards unless the tiles are added already grouped */
+void setBehaviour(int i,int kind,int axis,float speed,float lo,float hi)
+{
+    flor.kind[i]=kind;
+    if(axis==0)
+        flor.vx[i]=speed,flor.lox[i]=lo,flor.hix[i]=hi;
+    else if(axis==1)
+        flor.vy[i]=speed,flor.loy[i]=lo,flor.hiy[i]=hi;
+    else
+        flor.vz[i]=speed,flor.loz[i]=lo,flor.hiz[i]=hi;
+}
+/* Make the tile slide along the floor between its starting place and an edge of the
+   level: dir 0/1 the +z/-z edge, 2/3 the -x/+x edge */
+void slideBlock(int tile,int dir)
+{
+    if(dir == 0)
+        setBehaviour(tile,SLIDING_TILE,2,-0.025,flor.posz[tile],level.maxz);
+    if(dir == 1)
+        setBehaviour(tile,SLIDING_TILE,2,0.025,level.minz,flor.posz[tile]);
+    if(dir == 2)
+        setBehaviour(tile,SLIDING_TILE,0,0.025,level.minx,flor.posx[tile]);
+    if(dir == 3)
+        setBehaviour(tile,SLIDING_TILE,0,-0.025,flor.posx[tile],level.maxx);
+}
+/* Make the tile bob up and down around the floor level, starting in a random direction */
+void moveTile(int tile)
+{ 
+    unsigned int m=rng();
+    setBehaviour(tile,BOBBING_TILE,1,m%2==0?0.005:-0.005,Floor_limit-0.8,Floor_limit+0.8);
+}
+/* Move p by v, reversing v where p left [lo,hi]; written branch free so it vectorizes */
+void stepRange(float *p,float *v,const float *lo,const float *hi,int begin,int end)
 {
-    int no_of_deletions = 6;
-    int tiles_delete[]={14,22,79,43,63,80};
-    for(int i=0;i<no_of_deletions;i++)
+    for(int i=begin;i<end;i++)
     {
-       flor.erase(flor.begin()+tiles_delete[i]);
+        float q=p[i]+v[i];
+        p[i]=q;
+        v[i]=(q<lo[i]||q>hi[i])?-v[i]:v[i];
     }
 }
-void moveFloor()
+/* Sliding tiles that left their grid cell in the last step, gathered per job */
+vector<vector<int> > movedTiles;
+/* Advance every moving tile by one step, in slices on the job pool */
+void updateTiles()
 {
-    int no_of_moving = 4;
-    int moving[]= {8,26,42,73};
-    for(int i=0;i<no_of_moving;i++)
+    int bob_end=flor.bobbing, slide_end=flor.bobbing+flor.sliding;
+    int slices=sliceCount(slide_end,tile_grain);
+    if(movedTiles.size()<slices)
+        movedTiles.resize(slices);
+    runJobs(slices,[bob_end,slide_end,slices](int k){
+        int begin=sliceStart(slide_end,slices,k), end=sliceStart(slide_end,slices,k+1);
+        stepRange(flor.y.data(),flor.vy.data(),flor.loy.data(),flor.hiy.data(),begin,min(end,bob_end));
+        begin=max(begin,bob_end);
+        stepRange(flor.x.data(),flor.vx.data(),flor.lox.data(),flor.hix.data(),begin,end);
+        stepRange(flor.z.data(),flor.vz.data(),flor.loz.data(),flor.hiz.data(),begin,end);
+        // bobbing only changes y, so only sliding tiles can change cell
+        vector<int> &moved=movedTiles[k];
+        moved.clear();
+        for(int i=begin;i<end;i++)
+            if(gridCell(flor.x[i])!=flor.cellx[i]||gridCell(flor.z[i])!=flor.cellz[i])
+                moved.push_back(i);
+    });
+    // the grid is shared, so it is updated here in tile order
+    for(int k=0;k<slices;k++)
+        for(int j=0;j<movedTiles[k].size();j++)
+            gridUpdate(movedTiles[k][j]);
+
+    for(int k=0;k<crumbling.size();)
     {
-        moveTile(&flor[moving[i]]);
-        moveTile(&flor[moving[i]+9]);
+        int i=crumbling[k];
+        if(--flor.crumble[i]>0)
+        {
+            k++;
+            continue;
+        }
+        removeTile(i);
+        crumbling[k]=crumbling.back();
+        crumbling.pop_back();
     }
 }
-void slideBlock(object *tile,int dir)
+/* Remember where an object was before this simulation step, for interpolation */
+void savePosition(object *o)
 {
-    if(dir == 0)
-    {
-        cout<<"case 0\n";
-        if(tile->vz==0)
-                tile->vz=-0.025;
-        tile->z+=tile->vz;
-        if(tile->z<tile->posz||tile->z>5)
-            tile->vz*=-1;
+    o->lastx=o->x;
+    o->lasty=o->y;
+    o->lastz=o->z;
+}
+/* Position of an object between its last two simulation steps, alpha in [0,1] */
+glm::vec3 lerpPosition(const object &o,float alpha)
+{
+    return glm::vec3(o.lastx+(o.x-o.lastx)*alpha, o.lasty+(o.y-o.lasty)*alpha, o.lastz+(o.z-o.lastz)*alpha);
+}
+glm::vec3 lerpTile(int i,float alpha)
+{
+    return glm::vec3(flor.lastx[i]+(flor.x[i]-flor.lastx[i])*alpha,
+                     flor.lasty[i]+(flor.y[i]-flor.lasty[i])*alpha,
+                     flor.lastz[i]+(flor.z[i]-flor.lastz[i])*alpha);
+}
 
-    }
-    if(dir == 1)
-    {
-        cout<<"case 1\n";
-        if(tile->vz==0)
-                tile->vz=0.025;
-        tile->z+=tile->vz;
-        if(tile->z>tile->posz||tile->z<-5)
-            tile->vz*=-1;
+/* Advance the game by one fixed timestep */
+void update ()
+{
+    // static tiles never move, so their last position is already right
+    int moving=flor.bobbing+flor.sliding;
+    copy(flor.x.begin(), flor.x.begin()+moving, flor.lastx.begin());
+    copy(flor.y.begin(), flor.y.begin()+moving, flor.lasty.begin());
+    copy(flor.z.begin(), flor.z.begin()+moving, flor.lastz.begin());
+    for(int k=0;k<bodies.size();k++)
+        savePosition(bodies[k]);
+
+    profileBegin(STAGE_TILES);
+    streamWorld();
+    updateTiles();
+    profileEnd(STAGE_TILES);
+    profileBegin(STAGE_PHYSICS);
+    stepBodies(bodies.data(), bodies.size());
+    profileEnd(STAGE_PHYSICS);
+    profile.current.steps++;
+    sim_tick++;
 
-    }
-    if(dir == 2)
-    {
-        cout<<"case 2\n";
-        if(tile->vx==0)
-                tile->vx=0.025;
-        
-        tile->x+=tile->vx;
-        if(tile->x>tile->posx||tile->x<-5)
-            tile->vx*=-1;
+  // Increment angles
+  float increments = 1;
 
+  //camera_rotation_angle++; // Simulating camera rotation
+  triangle_rotation = triangle_rotation + increments*triangle_rot_dir*triangle_rot_status;
+  rectangle_rotation = rectangle_rotation + increments*rectangle_rot_dir*rectangle_rot_status;
+}
+
+/* The six planes of the view volume of VP, as (a,b,c,d) with ax+by+cz+d>=0 inside */
+void frustumPlanes(const glm::mat4 &VP,glm::vec4 planes[6])
+{
+    glm::vec4 row[4];
+    for(int i=0;i<4;i++)
+        row[i]=glm::vec4(VP[0][i],VP[1][i],VP[2][i],VP[3][i]);
+    for(int i=0;i<3;i++)
+    {
+        planes[2*i]=row[3]+row[i];
+        planes[2*i+1]=row[3]-row[i];
     }
-    if(dir == 3)
+}
+/* False only if the box is completely outside one of the planes */
+bool boxInFrustum(const glm::vec4 planes[6],const glm::vec3 &lo,const glm::vec3 &hi)
+{
+    for(int i=0;i<6;i++)
     {
-        cout<<"case 3\n";
-        if(tile->vx==0)
-                tile->vx=-0.025;
-        tile->x+=tile->vx;
-        if(tile->x<tile->posx||tile->x>5)
-            tile->vx*=-1;
-
+        // the corner furthest along the plane normal
+        glm::vec3 p(planes[i].x>=0?hi.x:lo.x, planes[i].y>=0?hi.y:lo.y, planes[i].z>=0?hi.z:lo.z);
+        if(planes[i].x*p.x+planes[i].y*p.y+planes[i].z*p.z+planes[i].w<0)
+            return false;
     }
+    return true;
 }
-void moveTile(object *tile)
-{ 
-    if(tile->vy==0)
+/* Collect the tile ranges of the chunks that can be seen, merged into as few runs as possible */
+void cullChunks(const glm::mat4 &VP,const glm::vec3 &centre)
+{
+    glm::vec4 planes[6];
+    frustumPlanes(VP,planes);
+    visibleRanges.clear();
+    visibleChunks.clear();
+    int moving=flor.bobbing+flor.sliding;
+    cullCount.chunksDrawn=cullCount.chunksCulled=0;
+    cullCount.tilesDrawn=cullCount.tilesCulled=0;
+    for(int i=0;i<chunks.size();i++)
     {
-        int m=rand();
-        if(m%2==0)
-                tile->vy=0.005;
+        const tileChunk &c=chunks[i];
+        float dx=max(max(c.lo.x-centre.x,centre.x-c.hi.x),0.0f);
+        float dy=max(max(c.lo.y-centre.y,centre.y-c.hi.y),0.0f);
+        float dz=max(max(c.lo.z-centre.z,centre.z-c.hi.z),0.0f);
+        bool seen=dx*dx+dy*dy+dz*dz<=draw_distance*draw_distance&&boxInFrustum(planes,c.lo,c.hi);
+        int tiles=0;
+        for(int k=0;k<c.ranges.size();k++)
+        {
+            tiles+=c.ranges[k].second-c.ranges[k].first;
+            // static tiles are drawn from the chunk's baked mesh
+            if(seen&&c.ranges[k].first<moving)
+                visibleRanges.push_back(make_pair(c.ranges[k].first,min(c.ranges[k].second,moving)));
+        }
+        if(seen)
+            visibleChunks.push_back(i);
+        if(seen)
+            cullCount.chunksDrawn++,cullCount.tilesDrawn+=tiles;
         else
-                tile->vy=-0.005;
+            cullCount.chunksCulled++,cullCount.tilesCulled+=tiles;
     }
-    tile->y+=tile->vy;
-    if((tile->y>Floor_limit+0.8)||(tile->y<Floor_limit-0.8))
-            tile->vy*=-1;
+    sort(visibleRanges.begin(), visibleRanges.end());
+    int merged=0;
+    for(int k=0;k<visibleRanges.size();k++)
+    {
+        if(merged>0&&visibleRanges[merged-1].second==visibleRanges[k].first)
+            visibleRanges[merged-1].second=visibleRanges[k].second;
+        else
+            visibleRanges[merged++]=visibleRanges[k];
+    }
+    visibleRanges.resize(merged);
 }
+
 /* Render the scene with openGL */
 /* Edit this function according to your assignment */
-void draw ()
+/* alpha is how far we are between the last two simulation steps */
+void draw (float alpha)
 {
   // clear the color and depth in the frame buffer
   glClear (GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT);
 
   // use the loaded shader program
   // Don't change unless you know what you are doing
-  glUseProgram (programID);
+  useProgram (programID);
 
   // Eye - Location of camera. Don't change unless you are sure!!
   glm::vec3 eye ( 5*cos(camera_rotation_angle*M_PI/180.0f), 0, 5*sin(camera_rotation_angle*M_PI/180.0f) );
@@ -812,71 +3209,74 @@ void draw ()
   // Matrices.view = glm::lookAt( eye, target, up ); // Rotating Camera for 3D
   //  Don't change unless you are sure!!
   
+  glm::vec3 playerPos=lerpPosition(player,alpha);
   if(camera.state){
-    camera.x=player.x+0.1;
-    camera.y=player.y+3;
-    camera.z=player.z+0.1;
+    camera.x=playerPos.x+0.1;
+    camera.y=playerPos.y+3;
+    camera.z=playerPos.z+0.1;
   }
  else
  {
-    camera.x=player.x+2;
-    camera.y=player.y+2;
-    camera.z=player.z+2;
+    camera.x=playerPos.x+2;
+    camera.y=playerPos.y+2;
+    camera.z=playerPos.z+2;
  
  }  
-  Matrices.view = glm::lookAt(glm::vec3(camera.x,camera.y,camera.z), glm::vec3(player.x,player.y,player.z), glm::vec3(0,1,0)); // Fixed camera for 2D (ortho) in XY plane
+  Matrices.view = glm::lookAt(glm::vec3(camera.x,camera.y,camera.z), playerPos, glm::vec3(0,1,0)); // Fixed camera for 2D (ortho) in XY plane
 
   // Compute ViewProject matrix as view/camera might not be changed for this frame (basic scenario)
   //  Don't change unless you are sure!!
   glm::mat4 VP = Matrices.projection * Matrices.view;
 
-  // Send our transformation to the currently bound shader, in the "MVP" uniform
-  // For each model you render, since the MVP will be different (at least the M part)
-  //  Don't change unless you are sure!!
-  glm::mat4 MVP;	// MVP = Projection * View * Model
-
-  // Load identity to model matrix
+  // VP goes to the shader once per frame, in the "VP" uniform; the model matrices
+  // come from the transform ring and are multiplied in on the GPU
 
   /* Render your scene */
-    moveFloor();
-    createObstacles();
-    for(int i=0;i<flor.size();i++)
-    {
-        Matrices.model = glm::mat4(1.0f);
-        object box=flor[i];
-        glm::mat4 translateTile = glm::translate (glm::vec3(box.x, box.y, box.z)); // glTranslatef
-
-        glm::mat4 floorTransform = translateTile;
-        Matrices.model *= floorTransform; 
-        MVP = VP * Matrices.model; // MVP = p * V * M
-
-        glUniformMatrix4fv(Matrices.MatrixID, 1, GL_FALSE, &MVP[0][0]);
-        draw3DObject(box.sprite); 
-    }
-  // draw3DObject draws the VAO given to it using current MVP matrix
-  //draw3DObject(triangle);
-  //draw3DObject(player.sprite);
-  // Pop matrix to undo transformations till last push matrix instead of recomputing model matrix
-  // glPopMatrix ();
-
-  /*glm::mat4 translateRectangle = glm::translate (glm::vec3(2, 0, 0));        // glTranslatef
-  glm::mat4 rotateRectangle = glm::rotate((float)(rectangle_rotation*M_PI/180.0f), glm::vec3(0,0,1)); // rotate about vector (-1,1,1)
-  */
-  Matrices.model = glm::mat4(1.0f);
-  glm::mat4 translatePlayer = glm::translate (glm::vec3(player.x, player.y, player.z)); // glTranslatef
-  Matrices.model *= translatePlayer;
-  MVP = VP * Matrices.model;
-  glUniformMatrix4fv(Matrices.MatrixID, 1, GL_FALSE, &MVP[0][0]);
-  draw3DObject(player.sprite);
-  gravity(&player);
-  // draw3DObject draws the VAO given to it using current MVP matrix
-
-  // Increment angles
-  float increments = 1;
-
-  //camera_rotation_angle++; // Simulating camera rotation
-  triangle_rotation = triangle_rotation + increments*triangle_rot_dir*triangle_rot_status;
-  rectangle_rotation = rectangle_rotation + increments*rectangle_rot_dir*rectangle_rot_status;
+  cullChunks(VP,playerPos);
+  // queue every draw of the frame with its model matrix, fill the transform ring, then send
+  // the draws sorted by the state they need
+  frameTransforms.clear();
+  frameDraws.clear();
+  // one draw per chunk for the static tiles, placed at the chunk's origin
+  bakeVisibleChunks(playerPos);
+  for(int k=0;k<visibleChunks.size();k++)
+  {
+    tileChunk &c=chunks[visibleChunks[k]];
+    if(c.baked)
+        queueDraw(programID, c.baked, glm::translate(glm::mat4(1.0f), c.origin));
+  }
+  // the moving tiles, which all come before the static ones
+  if(!instanced)
+    for(int k=0;k<visibleRanges.size();k++)
+    for(int i=visibleRanges[k].first;i<visibleRanges[k].second;i++)
+        if(flor.alive[i])
+            queueDraw(programID, flor.sprite, glm::translate (lerpTile(i,alpha))); // glTranslatef
+  for(int k=0;k<bodies.size();k++)
+    queueDraw(programID, bodies[k]->sprite, glm::translate (k==0?playerPos:lerpPosition(*bodies[k],alpha)));
+  uploadTransforms();
+  uploadMatrix(Matrices.MatrixID, VP);
+  submitDraws();
+
+  if(instanced)
+  {
+    floorOffsets.resize(4*(flor.bobbing+flor.sliding));
+    for(int i=0;i<flor.bobbing+flor.sliding;i++)
+    {
+        glm::vec3 p=lerpTile(i,alpha);
+        floorOffsets[4*i]=p.x;
+        floorOffsets[4*i+1]=p.y;
+        floorOffsets[4*i+2]=p.z;
+        floorOffsets[4*i+3]=flor.alive[i];  // removed tiles are scaled down to nothing
+    }
+    useProgram (instancedProgramID);
+    uploadMatrix(instancedVPID, VP);
+    updateInstanceBatch(&floorBatch, floorOffsets);
+    for(int k=0;k<visibleRanges.size();k++)
+    {
+        drawInstanceRange(&floorBatch, visibleRanges[k].first, visibleRanges[k].second-visibleRanges[k].first);
+    }
+  }
+  fenceTransforms();
 }
 
 /* Initialise glfw window, I/O callbacks and the renderer to use */
@@ -927,6 +3327,72 @@ GLFWwindow* initGLFW (int width, int height)
     return window;
 }
 
+/* Offscreen target: a GL 3.3 core context with no display and a framebuffer object to draw into */
+typedef struct offscreenTarget
+{
+    EGLDisplay display;
+    EGLContext context;
+    GLuint framebuffer, color, depth;
+    int width, height;
+}offscreenTarget;
+offscreenTarget target;
+
+/* Make a surfaceless EGL context, e.g. on Mesa's llvmpipe, and bind an FBO of width x height */
+void initOffscreen (int width, int height)
+{
+    target.display=EGL_NO_DISPLAY;
+    PFNEGLGETPLATFORMDISPLAYEXTPROC getPlatformDisplay=(PFNEGLGETPLATFORMDISPLAYEXTPROC)eglGetProcAddress("eglGetPlatformDisplayEXT");
+    if(getPlatformDisplay)
+        target.display=getPlatformDisplay(EGL_PLATFORM_SURFACELESS_MESA, EGL_DEFAULT_DISPLAY, NULL);
+    if(target.display==EGL_NO_DISPLAY)
+        target.display=eglGetDisplay(EGL_DEFAULT_DISPLAY);
+    if(target.display==EGL_NO_DISPLAY||!eglInitialize(target.display, NULL, NULL)||!eglBindAPI(EGL_OPENGL_API)){
+        fprintf(stderr, "Cannot open an EGL display for offscreen rendering\n");
+        exit(EXIT_FAILURE);
+    }
+    const EGLint config_attribs[]={EGL_RENDERABLE_TYPE, EGL_OPENGL_BIT, EGL_NONE};
+    EGLConfig config;
+    EGLint configs=0;
+    eglChooseConfig(target.display, config_attribs, &config, 1, &configs);
+    const EGLint context_attribs[]={
+        EGL_CONTEXT_MAJOR_VERSION, 3,
+        EGL_CONTEXT_MINOR_VERSION, 3,
+        EGL_CONTEXT_OPENGL_PROFILE_MASK, EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT,
+        EGL_NONE};
+    target.context=eglCreateContext(target.display, configs?config:EGL_NO_CONFIG_KHR, EGL_NO_CONTEXT, context_attribs);
+    if(target.context==EGL_NO_CONTEXT||!eglMakeCurrent(target.display, EGL_NO_SURFACE, EGL_NO_SURFACE, target.context)){
+        fprintf(stderr, "Cannot create an OpenGL 3.3 core context for offscreen rendering\n");
+        exit(EXIT_FAILURE);
+    }
+    gladLoadGLLoader((GLADloadproc) eglGetProcAddress);
+
+    target.width=width;
+    target.height=height;
+    glGenRenderbuffers(1, &target.color);
+    glBindRenderbuffer(GL_RENDERBUFFER, target.color);
+    glRenderbufferStorage(GL_RENDERBUFFER, GL_RGBA8, width, height);
+    glGenRenderbuffers(1, &target.depth);
+    glBindRenderbuffer(GL_RENDERBUFFER, target.depth);
+    glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT24, width, height);
+    glGenFramebuffers(1, &target.framebuffer);
+    glBindFramebuffer(GL_FRAMEBUFFER, target.framebuffer);
+    glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_RENDERBUFFER, target.color);
+    glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, target.depth);
+    if(glCheckFramebufferStatus(GL_FRAMEBUFFER)!=GL_FRAMEBUFFER_COMPLETE){
+        fprintf(stderr, "Offscreen framebuffer is incomplete\n");
+        exit(EXIT_FAILURE);
+    }
+}
+void stopOffscreen ()
+{
+    glDeleteFramebuffers(1, &target.framebuffer);
+    glDeleteRenderbuffers(1, &target.color);
+    glDeleteRenderbuffers(1, &target.depth);
+    eglMakeCurrent(target.display, EGL_NO_SURFACE, EGL_NO_SURFACE, EGL_NO_CONTEXT);
+    eglDestroyContext(target.display, target.context);
+    eglTerminate(target.display);
+}
+
 /* Initialize the OpenGL rendering properties */
 /* Add all the models to be created here */
 void initGL (GLFWwindow* window, int width, int height)
@@ -936,11 +3402,20 @@ void initGL (GLFWwindow* window, int width, int height)
 	//createTriangle (); // Generate the VAO, VBOs, vertices data & copy into the array buffer
 	//createRectangle ();
 	camera.state=0;
+    // Start every program first so the driver can build them while we load the level
+    initShaderCompiler();
+    shaderProgram programs[2]={
+        requestProgram( "Sample_GL_transforms.vert", "Sample_GL.frag" ),
+        requestProgram( "Sample_GL_instanced.vert", "Sample_GL.frag" )};
     createFloor();
-    // Create and compile our GLSL program from the shaders
-	programID = LoadShaders( "Sample_GL.vert", "Sample_GL.frag" );
-	// Get a handle for our "MVP" uniform
-	Matrices.MatrixID = glGetUniformLocation(programID, "MVP");
+	createInstanceBatch(&floorBatch, flor.sprite, flor.n);
+
+	programID = finishProgram(programs[0]);
+	// Get a handle for our "VP" uniform, the model matrices come from the transform ring
+	Matrices.MatrixID = glGetUniformLocation(programID, "VP");
+	useTransformRing(programID);
+	instancedProgramID = finishProgram(programs[1]);
+	instancedVPID = glGetUniformLocation(instancedProgramID, "VP");
 
 	
 	reshapeWindow (window, width, height);
@@ -958,24 +3433,716 @@ void initGL (GLFWwindow* window, int width, int height)
     cout << "GLSL: " << glGetString(GL_SHADING_LANGUAGE_VERSION) << endl;
 }
 
+/* One line of a headless input script */
+typedef struct scriptEvent
+{
+    long long tick;
+    int key;
+    int action;
+}scriptEvent;
+
+int keyByName(const string &name)
+{
+    if(name=="up") return GLFW_KEY_UP;
+    if(name=="down") return GLFW_KEY_DOWN;
+    if(name=="left") return GLFW_KEY_LEFT;
+    if(name=="right") return GLFW_KEY_RIGHT;
+    if(name=="space") return GLFW_KEY_SPACE;
+    if(name=="v") return GLFW_KEY_V;
+    return -1;
+}
+
+/* Script lines are "<tick> <key> <press|release>", e.g. "120 up press".
+   Keys are up, down, left, right, space and v; lines starting with # are skipped */
+vector<scriptEvent> loadScript(const char *script_path)
+{
+    vector<scriptEvent> events;
+    std::ifstream in(script_path, std::ios::in);
+    if(!in.is_open()){
+        fprintf(stderr, "Cannot open input script %s\n", script_path);
+        exit(EXIT_FAILURE);
+    }
+    string line;
+    int line_no=0;
+    while(getline(in, line))
+    {
+        line_no++;
+        if(line.empty()||line[0]=='#')
+            continue;
+        char key[32], action[32];
+        scriptEvent e;
+        if(sscanf(line.c_str(), "%lld %31s %31s", &e.tick, key, action)!=3||(e.key=keyByName(key))<0
+           ||(strcmp(action,"press")&&strcmp(action,"release"))){
+            fprintf(stderr, "%s:%d: bad input line '%s'\n", script_path, line_no, line.c_str());
+            exit(EXIT_FAILURE);
+        }
+        e.action=strcmp(action,"press")?GLFW_RELEASE:GLFW_PRESS;
+        events.push_back(e);
+    }
+    stable_sort(events.begin(), events.end(), [](const scriptEvent &a,const scriptEvent &b){ return a.tick<b.tick; });
+    return events;
+}
+
+/* Read a recording made with --record; the seed, level and length it was made
+   with replace the ones given on the command line */
+vector<scriptEvent> loadRecording(const char *path,unsigned int &seed,long long &ticks)
+{
+    static inputFileHeader h;
+    vector<scriptEvent> events;
+    FILE *in=fopen(path, "rb");
+    if(!in){
+        fprintf(stderr, "Cannot open input recording %s\n", path);
+        exit(EXIT_FAILURE);
+    }
+    if(fread(&h, sizeof(h), 1, in)!=1||memcmp(h.magic, "LVR1", 4)||h.version!=input_version||h.count<0){
+        fprintf(stderr, "%s is not an input recording\n", path);
+        exit(EXIT_FAILURE);
+    }
+    vector<inputFileEvent> raw(h.count);
+    if(h.count&&fread(&raw[0], sizeof(inputFileEvent), h.count, in)!=h.count){
+        fprintf(stderr, "%s is truncated\n", path);
+        exit(EXIT_FAILURE);
+    }
+    fclose(in);
+    h.level[sizeof(h.level)-1]=0;
+    for(int i=0;i<h.count;i++)
+    {
+        scriptEvent e={raw[i].tick, raw[i].key, raw[i].action};
+        events.push_back(e);
+    }
+    seed=h.seed;
+    ticks=h.ticks;
+    level_path=h.level;
+    return events;
+}
+
+/* Simulate the level for a number of fixed steps as fast as possible and report the rate */
+void runHeadless(long long ticks, const vector<scriptEvent> &events)
+{
+    camera.state=0;
+    createFloor();
+
+    int next=0;
+    std::chrono::steady_clock::time_point start=std::chrono::steady_clock::now();
+    for(long long tick=0;tick<ticks;tick++)
+    {
+        for(;next<events.size()&&events[next].tick<=tick;next++)
+            keyboard(NULL, events[next].key, 0, events[next].action, 0);
+        update();
+        profileEndFrame();
+    }
+    double elapsed=std::chrono::duration<double>(std::chrono::steady_clock::now()-start).count();
+
+    printf("ticks: %lld\n", ticks);
+    printf("seconds: %f\n", elapsed);
+    printf("ticks/s: %.0f\n", elapsed>0?ticks/elapsed:0.0);
+    printf("player: %f %f %f\n", player.x, player.y, player.z);
+    if(stream.active)
+        printf("chunks: %d resident of %d, %d loads (%d read on the main thread), %d evictions\n",
+               stream.resident, (int)chunks.size(), stream.loads, stream.misses, stream.evictions);
+    writeProfile();
+}
+
+/* CRC-32 of the PNG chunks, carried on from crc */
+unsigned int pngCrc(unsigned int crc,const unsigned char *p,size_t n)
+{
+    static unsigned int table[256];
+    if(!table[1])
+        for(unsigned int i=0;i<256;i++)
+        {
+            unsigned int c=i;
+            for(int k=0;k<8;k++)
+                c=c&1?0xedb88320u^(c>>1):c>>1;
+            table[i]=c;
+        }
+    crc=~crc;
+    for(size_t i=0;i<n;i++)
+        crc=table[(crc^p[i])&0xff]^(crc>>8);
+    return ~crc;
+}
+void pngChunk(FILE *out,const char *type,const vector<unsigned char> &data)
+{
+    unsigned char head[8]={(unsigned char)(data.size()>>24), (unsigned char)(data.size()>>16),
+                           (unsigned char)(data.size()>>8), (unsigned char)data.size()};
+    memcpy(head+4, type, 4);
+    unsigned int crc=pngCrc(pngCrc(0, head+4, 4), data.data(), data.size());
+    unsigned char tail[4]={(unsigned char)(crc>>24), (unsigned char)(crc>>16), (unsigned char)(crc>>8), (unsigned char)crc};
+    fwrite(head, 1, 8, out);
+    fwrite(data.data(), 1, data.size(), out);
+    fwrite(tail, 1, 4, out);
+}
+/* Save bottom-up RGBA pixels, as glReadPixels gives them, to an RGB PNG.
+   The image data is stored uncompressed so no zlib is needed; exact pixels are what golden images compare */
+bool writePNG(const char *path,int width,int height,const vector<unsigned char> &rgba)
+{
+    FILE *out=fopen(path, "wb");
+    if(!out){
+        fprintf(stderr, "Cannot write image %s\n", path);
+        return false;
+    }
+    // one filter byte and the RGB of every pixel per row, top row first
+    vector<unsigned char> raw;
+    raw.reserve((size_t)height*(3*width+1));
+    for(int y=height-1;y>=0;y--)
+    {
+        raw.push_back(0);
+        for(int x=0;x<width;x++)
+            raw.insert(raw.end(), &rgba[4*((size_t)y*width+x)], &rgba[4*((size_t)y*width+x)+3]);
+    }
+    // zlib stream of stored deflate blocks
+    vector<unsigned char> z;
+    z.push_back(0x78); z.push_back(0x01);
+    size_t at=0;
+    do{
+        size_t n=min<size_t>(65535, raw.size()-at);
+        z.push_back(at+n==raw.size());  // last block
+        z.push_back(n&0xff); z.push_back(n>>8);
+        z.push_back(~n&0xff); z.push_back((~n>>8)&0xff);
+        z.insert(z.end(), raw.begin()+at, raw.begin()+at+n);
+        at+=n;
+    }while(at<raw.size());
+    unsigned int a=1, b=0;
+    for(size_t i=0;i<raw.size();i++)
+        a=(a+raw[i])%65521, b=(b+a)%65521;
+    unsigned int adler=b<<16|a;
+    for(int k=3;k>=0;k--)
+        z.push_back(adler>>(8*k));
+
+    const unsigned char signature[8]={0x89, 'P', 'N', 'G', '\r', '\n', 0x1a, '\n'};
+    fwrite(signature, 1, 8, out);
+    vector<unsigned char> ihdr(13, 0);
+    for(int k=0;k<4;k++)
+    {
+        ihdr[k]=width>>(24-8*k);
+        ihdr[4+k]=height>>(24-8*k);
+    }
+    ihdr[8]=8;      // bits per channel
+    ihdr[9]=2;      // RGB
+    pngChunk(out, "IHDR", ihdr);
+    pngChunk(out, "IDAT", z);
+    pngChunk(out, "IEND", vector<unsigned char>());
+    fclose(out);
+    return true;
+}
+
+/* Play the level like the window does, one step and one frame per tick, drawing into the
+   offscreen framebuffer. Every png_every-th frame, or only the last one when png_every is 0,
+   is saved to png_dir */
+void runOffscreen(long long ticks, const vector<scriptEvent> &events, int width, int height,
+                  const char *png_dir, int png_every)
+{
+    vector<unsigned char> pixels;
+    if(png_dir){
+        mkdir(png_dir, 0755);
+        pixels.resize((size_t)4*width*height);
+    }
+
+    int next=0;
+    std::chrono::steady_clock::time_point start=std::chrono::steady_clock::now();
+    for(long long tick=0;tick<ticks;tick++)
+    {
+        for(;next<events.size()&&events[next].tick<=tick;next++)
+            keyboard(NULL, events[next].key, 0, events[next].action, 0);
+        update();
+
+        int query = gpuTimerBegin();
+        profileBegin(STAGE_DRAW);
+        draw(1);
+        profileEnd(STAGE_DRAW);
+        gpuTimerEnd(query);
+
+        // nothing to swap, so wait for the frame to be rendered instead
+        profileBegin(STAGE_SWAP);
+        glFinish();
+        profileEnd(STAGE_SWAP);
+        profileEndFrame();
+
+        if(png_dir&&(png_every?(tick+1)%png_every==0:tick+1==ticks)){
+            glPixelStorei(GL_PACK_ALIGNMENT, 1);
+            glReadPixels(0, 0, width, height, GL_RGBA, GL_UNSIGNED_BYTE, pixels.data());
+            char path[4096];
+            snprintf(path, sizeof(path), "%s/frame_%06lld.png", png_dir, tick+1);
+            writePNG(path, width, height, pixels);
+        }
+    }
+    double elapsed=std::chrono::duration<double>(std::chrono::steady_clock::now()-start).count();
+
+    printf("frames: %lld\n", ticks);
+    printf("seconds: %f\n", elapsed);
+    printf("frames/s: %.1f\n", elapsed>0?ticks/elapsed:0.0);
+    printf("player: %f %f %f\n", player.x, player.y, player.z);
+    collectGpuQueries();
+    printf("%s\n", profileSummary().c_str());
+    writeProfile();
+}
+
+/* Fill flor with an n x n board centred on the origin: mostly static tiles with
+   some holes, bobbing and sliding tiles, all picked by rng */
+void buildSyntheticBoard(int n)
+{
+    stopStreaming();
+    flor=tileStore();
+    crumbling.clear();
+    level.minx=level.minz=-n/2;
+    level.maxx=level.maxz=n-n/2;
+    level.floory=Floor_limit=-2;
+    std::uniform_int_distribution<int> percent(0,99);
+    std::uniform_int_distribution<int> direction(0,3);
+    for(int i=0;i<n;i++)
+        for(int j=0;j<n;j++)
+        {
+            int roll=percent(rng);
+            if(roll<3)
+                continue;   // hole
+            int t=addTile(level.minx+i,level.floory,level.minz+j,0.5);
+            if(roll<8)
+                moveTile(t);
+            else if(roll<10)
+            {
+                flor.y[t]=level.floory+1;
+                slideBlock(t,direction(rng));
+            }
+        }
+    groupMovingTiles();
+    flor.lastx=flor.x;
+    flor.lasty=flor.y;
+    flor.lastz=flor.z;
+}
+
+typedef struct benchResult
+{
+    string name;
+    int size;
+    int threads;
+    long long ops;
+    double median_ns,min_ns;    // per operation
+}benchResult;
+vector<benchResult> benchResults;
+const int bench_runs = 5;
+
+/* Time body() bench_runs times and record the median and fastest nanoseconds per operation;
+   reset() runs untimed before each run */
+template <typename F,typename R> void benchRun(const char *name,int size,long long ops,F body,R reset)
+{
+    reset();
+    body();     // warm up caches and allocations
+    vector<double> ns;
+    for(int r=0;r<bench_runs;r++)
+    {
+        reset();
+        std::chrono::steady_clock::time_point start=std::chrono::steady_clock::now();
+        body();
+        ns.push_back(std::chrono::duration<double,std::nano>(std::chrono::steady_clock::now()-start).count()/ops);
+    }
+    sort(ns.begin(), ns.end());
+    benchResult r;
+    r.name=name;
+    r.size=size;
+    r.threads=job_threads;
+    r.ops=ops;
+    r.median_ns=ns[ns.size()/2];
+    r.min_ns=ns[0];
+    benchResults.push_back(r);
+    char board[32];
+    snprintf(board, sizeof(board), "%dx%d", size, size);
+    printf("%-12s %-14s %7d %10lld %14.1f %12.1f\n", board, name, job_threads, ops, r.median_ns, r.min_ns);
+    fflush(stdout);
+}
+template <typename F> void benchRun(const char *name,int size,long long ops,F body)
+{
+    benchRun(name, size, ops, body, [](){});
+}
+
+/* What removeTile clears about a tile, so a benchmark can put it back in its own slot */
+typedef struct tileSnapshot
+{
+    int i;
+    float vx,vy,vz;
+    float lox,hix,loy,hiy,loz,hiz;
+    int kind,crumble;
+}tileSnapshot;
+tileSnapshot saveTile(int i)
+{
+    tileSnapshot t={i, flor.vx[i], flor.vy[i], flor.vz[i],
+                    flor.lox[i], flor.hix[i], flor.loy[i], flor.hiy[i], flor.loz[i], flor.hiz[i],
+                    flor.kind[i], flor.crumble[i]};
+    return t;
+}
+/* Undo removeTile; the caller takes the slot back off flor.freeSlots */
+void restoreTile(const tileSnapshot &t)
+{
+    int i=t.i;
+    flor.vx[i]=t.vx; flor.vy[i]=t.vy; flor.vz[i]=t.vz;
+    flor.lox[i]=t.lox; flor.hix[i]=t.hix;
+    flor.loy[i]=t.loy; flor.hiy[i]=t.hiy;
+    flor.loz[i]=t.loz; flor.hiz[i]=t.hiz;
+    flor.kind[i]=t.kind;
+    flor.crumble[i]=t.crumble;
+    flor.alive[i]=1;
+    gridInsert(i);
+    markTileDirty(flor.x[i],flor.z[i]);
+}
+
+/* Put the player at p standing still, as every query below starts from */
+void placePlayer(const glm::vec3 &p)
+{
+    player.x=p.x; player.y=p.y; player.z=p.z;
+    player.vx=player.vy=player.vz=0;
+}
+
+/* Time the physics and level systems on synthetic boards, every run on the same boards */
+/* The cases that run on the job pool are timed on 1, 2, 4... threads up to threads */
+void runBenchmarks(const vector<int> &sizes,unsigned int seed,const char *out_path,int threads)
+{
+    player.size=0.2;
+    vector<int> counts;
+    for(int t=1;t<threads;t*=2)
+        counts.push_back(t);
+    counts.push_back(threads);
+    startJobs(1);
+    printf("%-12s %-14s %7s %10s %14s %12s\n", "board", "case", "threads", "ops", "median ns/op", "min ns/op");
+    for(int k=0;k<sizes.size();k++)
+    {
+        int n=sizes[k];
+        rng.seed(seed);
+        buildSyntheticBoard(n);
+
+        // places on the board, just above the floor so the player touches tiles
+        const int queries=100000;
+        vector<glm::vec3> spots(queries);
+        std::uniform_real_distribution<float> across(level.minx, level.maxx);
+        for(int i=0;i<queries;i++)
+            spots[i]=glm::vec3(across(rng), level.floory+0.6, across(rng));
+
+        volatile int sink=0;
+        benchRun("checkFloor", n, queries, [&](){
+            for(int i=0;i<queries;i++)
+            {
+                placePlayer(spots[i]);
+                sink+=checkFloor(&player);
+            }
+        });
+        benchRun("gravity", n, queries, [&](){
+            for(int i=0;i<queries;i++)
+            {
+                placePlayer(spots[i]);
+                gravity(&player);
+            }
+        });
+        // a crowd of bodies stepped together, to time the whole pipeline including body pairs;
+        // every round puts it on the next spots, so it covers the board like the queries above
+        const int crowd=1024;   // four slices of body_grain, so the pool has something to share
+        vector<object> crowdBodies(crowd);
+        vector<object*> crowdList(crowd);
+        for(int i=0;i<crowd;i++)
+            crowdList[i]=&crowdBodies[i];
+        // about a million tile moves per run whatever the board size
+        int moving=max(1,flor.bobbing+flor.sliding);
+        int steps=max(1,1000000/moving);
+        for(int t=0;t<counts.size();t++)
+        {
+            startJobs(counts[t]);
+            benchRun("stepBodies", n, (long long)crowd*(queries/crowd), [&](){
+                for(int r=0;r<queries/crowd;r++)
+                {
+                    for(int i=0;i<crowd;i++)
+                    {
+                        object &b=crowdBodies[i];
+                        b=object();
+                        const glm::vec3 &p=spots[r*crowd+i];
+                        b.x=p.x; b.y=p.y; b.z=p.z;
+                        b.size=0.2;
+                        b.mass=1;
+                    }
+                    stepBodies(crowdList.data(), crowd);
+                }
+            });
+            benchRun("updateTiles", n, (long long)steps*moving, [&](){
+                for(int i=0;i<steps;i++)
+                    updateTiles();
+            });
+        }
+        startJobs(1);
+
+        // remove a tenth of the board and put it back, so every run starts from the same board
+        vector<int> victims;
+        for(int i=0;i<flor.n;i++)
+            if(flor.alive[i])
+                victims.push_back(i);
+        shuffle(victims.begin(), victims.end(), rng);
+        victims.resize(min((int)victims.size(),max(1,flor.n/10)));
+        vector<tileSnapshot> saved(victims.size());
+        for(int i=0;i<victims.size();i++)
+            saved[i]=saveTile(victims[i]);
+        int freeBefore=flor.freeSlots.size();
+        bool removed=false;
+        benchRun("removeTile", n, victims.size(), [&](){
+            for(int i=0;i<victims.size();i++)
+                removeTile(victims[i]);
+            removed=true;
+        }, [&](){
+            if(removed)
+            {
+                for(int i=victims.size()-1;i>=0;i--)
+                    restoreTile(saved[i]);
+                flor.freeSlots.resize(freeBefore);
+            }
+            removed=false;
+        });
+        (void)sink;
+    }
+
+    if(out_path){
+        FILE *out=fopen(out_path, "w");
+        if(!out){
+            fprintf(stderr, "Cannot write benchmark results %s\n", out_path);
+            exit(EXIT_FAILURE);
+        }
+        fprintf(out, "case,board,threads,ops,median_ns_per_op,min_ns_per_op\n");
+        for(int i=0;i<benchResults.size();i++)
+            fprintf(out, "%s,%d,%d,%lld,%.3f,%.3f\n", benchResults[i].name.c_str(), benchResults[i].size,
+                    benchResults[i].threads, benchResults[i].ops, benchResults[i].median_ns, benchResults[i].min_ns);
+        fclose(out);
+    }
+}
+
+/* An empty board of level tiles to run the checks on */
+void clearBoard()
+{
+    stopStreaming();
+    flor=tileStore();
+    crumbling.clear();
+    level.minx=level.minz=-32;
+    level.maxx=level.maxz=32;
+    level.floory=Floor_limit=-2;
+}
+/* Drop a body at (x,z) from just above the floor tiles at speed; true if it comes to rest
+   on top of them. Just above, so the first step would end below a tile if not swept */
+bool dropBody(float x,float z,float speed,float &rest)
+{
+    object b=object();
+    b.x=x;
+    b.z=z;
+    b.size=0.2;
+    b.mass=1;
+    float top=level.floory+level_tile_size+b.size;
+    b.y=top+0.05;
+    b.vy=-speed;
+    object *list=&b;
+    bool tunnelled=false;
+    for(int step=0;step<100;step++)
+    {
+        stepBodies(&list,1);
+        tunnelled|=b.y<level.floory;
+    }
+    rest=b.y;
+    return !tunnelled&&fabsf(b.y-top)<0.05;
+}
+
+/* Drop a body onto a lone tile at each speed; every one of these speeds but the last
+   would carry it through the tile in a single discrete step. Returns the number of failed drops */
+int checkLandings()
+{
+    const float speeds[]={1.5, 3, 7, 0.4};  // the last is the terminal speed of a fall
+    int failed=0;
+    for(int k=0;k<sizeof(speeds)/sizeof(speeds[0]);k++)
+    {
+        clearBoard();
+        addTile(0,level.floory,0,level_tile_size);
+        groupMovingTiles();
+        float rest;
+        bool ok=dropBody(0,0,speeds[k],rest);
+        printf("drop at %.1f units/step: %s (rests at %f)\n", speeds[k], ok?"ok":"FAILED", rest);
+        failed+=!ok;
+    }
+    return failed;
+}
+
+/* Is tile i in the chunk at its place, among the static tiles baked into that chunk's mesh? */
+bool tileBaked(int i)
+{
+    unordered_map<long long,int>::const_iterator it=chunkIndex.find(gridKey(chunkOf(flor.x[i]),chunkOf(flor.z[i])));
+    if(it==chunkIndex.end()||flor.chunk[i]!=it->second||i<flor.bobbing+flor.sliding)
+        return false;
+    const tileChunk &c=chunks[it->second];
+    bool ranged=false;
+    for(int k=0;k<c.ranges.size();k++)
+        ranged|=i>=c.ranges[k].first&&i<c.ranges[k].second;
+    vector<packedVertex> vertices;
+    vector<GLuint> indices;
+    bakeTiles(c, glm::vec3(0), vertices, indices);
+    return ranged&&c.dirty&&!indices.empty();
+}
+/* Add a tile into the slot of a removed one and another with no free slot left, each in a
+   chunk of its own, and check both are baked and hold a body up. Removing a moving tile must
+   not free its slot, which would put a static tile among the moving ones. Returns the failures */
+int checkAddedTiles()
+{
+    clearBoard();
+    int still=addTile(0,level.floory,0,level_tile_size);
+    moveTile(addTile(4,level.floory,0,level_tile_size));
+    groupMovingTiles();
+    for(int i=0;i<flor.n;i++)
+        if(flor.kind[i]==STATIC_TILE)
+            still=i;
+    removeTile(0);      // the bobbing tile, kept first
+    removeTile(still);
+    int failed=0;
+    const float places[2][2]={{20,0},{-20,-12}};
+    for(int k=0;k<2;k++)
+    {
+        bool reused=!flor.freeSlots.empty();
+        int i=addTile(places[k][0],level.floory,places[k][1],level_tile_size);
+        float rest;
+        bool ok=tileBaked(i)&&dropBody(places[k][0],places[k][1],0.4,rest);
+        printf("tile added %s: %s (slot %d)\n", reused?"in a freed slot":"with no free slot", ok?"ok":"FAILED", i);
+        failed+=!ok;
+    }
+    return failed;
+}
+
 int main (int argc, char** argv)
 {	int width = 1000;
 	int height = 1000;
 
+    long long ticks = 10000;
+    const char *script_path = NULL;
+    const char *record_path = NULL;
+    const char *replay_path = NULL;
+    profile.dump_path = NULL;
+    bool bench = false;
+    bool check = false;
+    const char *bench_out = NULL;
+    vector<int> bench_sizes;
+    unsigned int seed = 1;
+    int threads = max(1u, std::thread::hardware_concurrency());
+    const char *png_dir = NULL;
+    int png_every = 0;
+    for(int i=1;i<argc;i++)
+    {
+        if(!strcmp(argv[i],"--headless"))
+            headless=true;
+        else if(!strcmp(argv[i],"--offscreen"))
+            offscreen=true;
+        else if(!strcmp(argv[i],"--png")&&i+1<argc)
+            png_dir=argv[++i];
+        else if(!strcmp(argv[i],"--png-every")&&i+1<argc)
+            png_every=max(0, atoi(argv[++i]));
+        else if(!strcmp(argv[i],"--size")&&i+1<argc&&sscanf(argv[i+1], "%dx%d", &width, &height)==2)
+            i++;
+        else if(!strcmp(argv[i],"--ticks")&&i+1<argc)
+            ticks=atoll(argv[++i]);
+        else if(!strcmp(argv[i],"--script")&&i+1<argc)
+            script_path=argv[++i];
+        else if(!strcmp(argv[i],"--record")&&i+1<argc)
+            record_path=argv[++i];
+        else if(!strcmp(argv[i],"--replay")&&i+1<argc)
+            replay_path=argv[++i];
+        else if(!strcmp(argv[i],"--level")&&i+1<argc)
+            level_path=argv[++i];
+        else if(!strcmp(argv[i],"--profile")&&i+1<argc)
+            profile.dump_path=argv[++i];
+        else if(!strcmp(argv[i],"--seed")&&i+1<argc)
+            seed=strtoul(argv[++i], NULL, 10);
+        else if(!strcmp(argv[i],"--bench"))
+            bench=true;
+        else if(!strcmp(argv[i],"--check"))
+            check=true;
+        else if(!strcmp(argv[i],"--bench-size")&&i+1<argc)
+            bench_sizes.push_back(atoi(argv[++i]));
+        else if(!strcmp(argv[i],"--bench-out")&&i+1<argc)
+            bench_out=argv[++i];
+        else if(!strcmp(argv[i],"--threads")&&i+1<argc)
+            threads=max(1, atoi(argv[++i]));
+        else{
+            fprintf(stderr, "usage: %s [--level FILE] [--profile FILE] [--seed N] [--threads N] [--record FILE] [--headless [--ticks N] [--script FILE]]\n"
+                            "       %s --offscreen [--ticks N] [--script FILE] [--size WxH] [--png DIR [--png-every N]] [--level FILE] [--profile FILE]\n"
+                            "       %s --replay FILE [--profile FILE] [--threads N]\n"
+                            "       %s --bench [--bench-size N]... [--bench-out FILE] [--seed N] [--threads N]\n"
+                            "       %s --check [--threads N]\n", argv[0], argv[0], argv[0], argv[0], argv[0]);
+            exit(EXIT_FAILURE);
+        }
+    }
+    vector<scriptEvent> events;
+    if(replay_path){
+        headless=true;
+        events=loadRecording(replay_path, seed, ticks);
+    }
+    else if((headless||offscreen)&&script_path)
+        events=loadScript(script_path);
+    rng.seed(seed);
+    if(bench){
+        headless=true;
+        if(bench_sizes.empty()){
+            bench_sizes.push_back(10);
+            bench_sizes.push_back(100);
+            bench_sizes.push_back(1000);
+        }
+        runBenchmarks(bench_sizes, seed, bench_out, threads);
+        exit(EXIT_SUCCESS);
+    }
+    startJobs(threads);
+    if(check){
+        headless=true;
+        int failed=checkLandings();
+        failed+=checkAddedTiles();
+        exit(failed?EXIT_FAILURE:EXIT_SUCCESS);
+    }
+    if(headless){
+        // a headless step is cheap, so only pay for timing it when asked to
+        if(profile.dump_path)
+            initProfiler(false);
+        runHeadless(ticks, events);
+        exit(EXIT_SUCCESS);
+    }
+    if(offscreen){
+        // saved frames are compared against golden images, so none may depend on the loader thread
+        exact_frames=png_dir!=NULL;
+        initOffscreen(width, height);
+        initGL(NULL, width, height);
+        // one untimed frame, so building the level's buffers is not counted as the first frame
+        draw(0);
+        glFinish();
+        initProfiler(true);
+        runOffscreen(ticks, events, width, height, png_dir, png_every);
+        stopOffscreen();
+        exit(EXIT_SUCCESS);
+    }
+
     GLFWwindow* window = initGLFW(width, height);
 
 	initGL (window, width, height);
+    initProfiler(true);
+    if(record_path)
+        startRecording(record_path, seed, level_path);
 
     double last_update_time = glfwGetTime(), current_time;
+    double last_frame_time = last_update_time, accumulator = 0;
 
     /* Draw in loop */
     while (!glfwWindowShouldClose(window)) {
 
-        // OpenGL Draw commands
-        draw();
+        // Run as many fixed simulation steps as the elapsed time asks for
+        current_time = glfwGetTime();
+        accumulator += min(current_time - last_frame_time, max_frame_time);
+        last_frame_time = current_time;
+        while (accumulator >= timestep) {
+            update();
+            accumulator -= timestep;
+        }
+
+        // OpenGL Draw commands, blended between the last two steps
+        int query = gpuTimerBegin();
+        profileBegin(STAGE_DRAW);
+        draw(accumulator/timestep);
+        profileEnd(STAGE_DRAW);
+        gpuTimerEnd(query);
 
         // Swap Frame Buffer in double buffering
+        profileBegin(STAGE_SWAP);
         glfwSwapBuffers(window);
+        profileEnd(STAGE_SWAP);
+        profileEndFrame();
 
         // Poll for Keyboard and mouse events
         glfwPollEvents();
@@ -983,11 +4150,18 @@ int main (int argc, char** argv)
         // Control based on time (Time based transformation like 5 degrees rotation every 0.5s)
         current_time = glfwGetTime(); // Time in seconds
         if ((current_time - last_update_time) >= 0.5) { // atleast 0.5s elapsed since last frame
-            // do something every 0.5 seconds ..
+            // show the frame time percentiles and the culling counts in the title
+            char chunk_text[128];
+            snprintf(chunk_text, sizeof(chunk_text), "  chunks %d/%d  tiles %d/%d",
+                     cullCount.chunksDrawn, cullCount.chunksDrawn+cullCount.chunksCulled,
+                     cullCount.tilesDrawn, cullCount.tilesDrawn+cullCount.tilesCulled);
+            glfwSetWindowTitle(window, (profileSummary()+chunk_text).c_str());
             last_update_time = current_time;
         }
     }
 
+    writeProfile();
+    stopRecording();
     glfwTerminate();
     exit(EXIT_SUCCESS);
 }
@@ -0,0 +1,117 @@
+#ifndef TRANSFORM_RING_H
+#define TRANSFORM_RING_H
+
+/* Shared by both games: include after glad and glm, in the one file that makes up the program */
+#include <cstring>
+#include <vector>
+
+/* The model matrices of a frame's draws go into one uniform buffer, and the shader picks
+   one by index, so a draw costs one glUniform1i instead of a matrix upload. The buffer is
+   split into transform_frames parts used in turn: the CPU fills one while the GPU may still
+   read the others, and a fence per part tells when it is free again. It stays mapped for
+   good when the driver has ARB_buffer_storage and is mapped once per frame otherwise */
+const int transform_frames = 3;
+const int transform_window = 256;   // matrices the shader's block sees at once, 16 KB
+typedef struct transformRing
+{
+    GLuint buffer;
+    int capacity;                   // matrices per part, a whole number of windows
+    glm::mat4 *mapped;              // the whole buffer when persistently mapped, else NULL
+    GLsync fences[transform_frames];
+    int part;                       // the part this frame uses
+    int window;                     // the window bound to the block, -1 for none yet
+    GLint objectIndexID;
+}transformRing;
+transformRing transforms;
+std::vector<glm::mat4> frameTransforms;    // this frame's model matrices, in the order they were added
+
+void waitTransformPart(int part)
+{
+    GLsync &fence=transforms.fences[part];
+    if(!fence)
+        return;
+    while(glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, 1000000000)==GL_TIMEOUT_EXPIRED)
+        ;
+    glDeleteSync(fence);
+    fence=0;
+}
+
+/* (Re)make the buffer with room for at least capacity matrices in each part */
+void createTransformRing(int capacity)
+{
+    for(int k=0;k<transform_frames;k++)
+        waitTransformPart(k);
+    if(transforms.buffer){
+        glBindBuffer(GL_UNIFORM_BUFFER, transforms.buffer);
+        if(transforms.mapped)
+            glUnmapBuffer(GL_UNIFORM_BUFFER);
+        glDeleteBuffers(1, &transforms.buffer);
+    }
+    transforms.capacity=(capacity+transform_window-1)/transform_window*transform_window;
+    GLsizeiptr size=(GLsizeiptr)transform_frames*transforms.capacity*sizeof(glm::mat4);
+    glGenBuffers(1, &transforms.buffer);
+    glBindBuffer(GL_UNIFORM_BUFFER, transforms.buffer);
+    transforms.mapped=NULL;
+    if(GLAD_GL_ARB_buffer_storage){
+        GLbitfield flags=GL_MAP_WRITE_BIT|GL_MAP_PERSISTENT_BIT|GL_MAP_COHERENT_BIT;
+        glBufferStorage(GL_UNIFORM_BUFFER, size, NULL, flags);
+        transforms.mapped=(glm::mat4*)glMapBufferRange(GL_UNIFORM_BUFFER, 0, size, flags);
+    }
+    else
+        glBufferData(GL_UNIFORM_BUFFER, size, NULL, GL_STREAM_DRAW);
+    transforms.window=-1;
+}
+
+/* Point program's ObjectTransforms block at binding 0, where the ring's windows go */
+void useTransformRing(GLuint program)
+{
+    glUniformBlockBinding(program, glGetUniformBlockIndex(program, "ObjectTransforms"), 0);
+    transforms.objectIndexID=glGetUniformLocation(program, "objectIndex");
+    if(!transforms.buffer)
+        createTransformRing(transform_window);
+}
+
+/* Move on to the next part and copy frameTransforms into it; draws come after this */
+void uploadTransforms()
+{
+    int count=frameTransforms.size();
+    if(count>transforms.capacity)
+        createTransformRing(count);
+    transforms.part=(transforms.part+1)%transform_frames;
+    transforms.window=-1;
+    waitTransformPart(transforms.part);
+    if(!count)
+        return;
+    GLintptr offset=(GLintptr)transforms.part*transforms.capacity*sizeof(glm::mat4);
+    GLsizeiptr bytes=count*sizeof(glm::mat4);
+    if(transforms.mapped)
+        memcpy((char*)transforms.mapped+offset, frameTransforms.data(), bytes);
+    else{
+        // the fence already says the GPU is done with this part, so no need to sync again
+        glBindBuffer(GL_UNIFORM_BUFFER, transforms.buffer);
+        void *part=glMapBufferRange(GL_UNIFORM_BUFFER, offset, bytes, GL_MAP_WRITE_BIT|GL_MAP_INVALIDATE_RANGE_BIT|GL_MAP_UNSYNCHRONIZED_BIT);
+        memcpy(part, frameTransforms.data(), bytes);
+        glUnmapBuffer(GL_UNIFORM_BUFFER);
+    }
+}
+
+/* After the frame's last draw from the ring, so its part is not written until the GPU is done */
+void fenceTransforms()
+{
+    transforms.fences[transforms.part]=glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0);
+}
+
+/* Make frameTransforms[transform] the model matrix of the next draw; the program using
+   the ring must be in use */
+void selectTransform(int transform)
+{
+    int window=transform/transform_window;
+    if(window!=transforms.window){
+        GLintptr first=(GLintptr)transforms.part*transforms.capacity+window*transform_window;
+        glBindBufferRange(GL_UNIFORM_BUFFER, 0, transforms.buffer, first*sizeof(glm::mat4), transform_window*sizeof(glm::mat4));
+        transforms.window=window;
+    }
+    glUniform1i(transforms.objectIndexID, transform%transform_window);
+}
+
+#endif